@@ -1,15 +1,46 @@
 #!/usr/bin/env python
 
 import os, sys, time, argparse
-import rlcompleter, readline
+import threading, queue
 import cv2
 import numpy as np
 from cvguipy import cvgui, cvgeom
 
+# numba is optional, if available it is used to mask the foreground frame in a single pass
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def maskFrame(img, mask, out):
+        """Copy the pixels of img where mask is nonzero to out, and zero the rest."""
+        h, w, c = img.shape
+        for i in prange(h):
+            for j in range(w):
+                if mask[i, j]:
+                    for k in range(c):
+                        out[i, j, k] = img[i, j, k]
+                else:
+                    for k in range(c):
+                        out[i, j, k] = 0
+
 class bsubPlayer(cvgui.cvPlayer):
-    def __init__(self, videoFilename):
+    def __init__(self, videoFilename, prefetch=8, useCuda=False, scale=1.0, maxLatency=None, history=200, varThreshold=16):
         super(bsubPlayer, self).__init__(videoFilename, fps=10000.0)
         
+        # frames are decoded ahead of time in a separate thread
+        self.prefetch = prefetch
+        self.frameQueue = None
+        self.reader = None
+        self.readerAlive = threading.Event()
+        
+        # if frames back up by more than maxLatency (ms), drop them to keep up with the video
+        self.maxLatency = maxLatency
+        self.dropThreshold = None
+        self.framesDropped = 0
+        
         self.maxCorners = 1000
         self.qualityLevel = 0.01
         self.minDistance = 5
@@ -17,35 +48,181 @@ class bsubPlayer(cvgui.cvPlayer):
         self.fgmask = None
         self.fgframe = None
         
+        # MOG2 parameters (shorter history is cheaper, but adapts faster to stopped objects)
+        self.history = history
+        self.varThreshold = varThreshold
+        
+        # scale frames by this factor before background subtraction (mask is scaled back up)
+        self.scale = scale
+        self.smallMask = None
+        
+        # background subtraction on the GPU (if OpenCV was built with CUDA)
+        self.useCuda = useCuda
+        self.stream = None
+        self.gpuFrame = None
+        self.gpuMask = None
+        
     def open(self):
         self.openWindow()
         self.openVideo()
         self.startBackSub()
         
+    def startReader(self):
+        """Start a thread that decodes frames into a bounded queue ahead of the player."""
+        maxsize = self.prefetch
+        if self.maxLatency is not None:
+            self.dropThreshold = max(1, int(self.fps * self.maxLatency / 1000.0))
+            maxsize = max(maxsize, 2 * self.dropThreshold)
+        self.frameQueue = queue.Queue(maxsize=maxsize)
+        self.readerAlive.set()
+        self.reader = threading.Thread(target=self.readFrames)
+        self.reader.daemon = True
+        self.reader.start()
+        
+    def stopReader(self):
+        """Stop the reader thread and throw away any frames it read ahead."""
+        if self.reader is not None:
+            self.readerAlive.clear()
+            while self.reader.is_alive():
+                # empty the queue so the reader can't stay blocked on put
+                try:
+                    self.frameQueue.get_nowait()
+                except queue.Empty:
+                    pass
+                self.reader.join(0.01)
+            self.reader = None
+        
+    def readFrames(self):
+        """Reader thread target. Blocks when the queue is full (back-pressure)."""
+        while self.readerAlive.is_set():
+            frameOK, image = self.video.read()
+            posFrames = int(self.video.get(cvgui.cvCAP_PROP_POS_FRAMES))
+            while self.readerAlive.is_set():
+                try:
+                    self.frameQueue.put((frameOK, image, posFrames), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not frameOK:
+                break
+        
+    def readFrame(self):
+        """Get the next frame from the reader thread instead of the video directly."""
+        if not self.video.isOpened():
+            return False
+        if self.reader is None:
+            self.startReader()
+        frameOK, image, posFrames = self.frameQueue.get()
+        if self.dropThreshold is not None and frameOK and self.frameQueue.qsize() > self.dropThreshold:
+            # background subtraction is falling behind, skip frames (the model just gets fewer updates)
+            while frameOK and self.frameQueue.qsize() > self.dropThreshold // 2:
+                frameOK, image, posFrames = self.frameQueue.get()
+                self.framesDropped += 1
+        self.frameOK = frameOK
+        if self.frameOK:
+            self.lastFrameImage = self.image
+            self.image = image
+            self.img = self.image.copy()
+            if self.imgHeight is None:
+                self.imgHeight, self.imgWidth, self.imgDepth = self.image.shape
+            self.posFrames = posFrames
+            self.frameTrackbar.update(self.posFrames)
+        else:
+            # reader stops at the end of the video
+            self.reader = None
+        return self.frameOK
+    
+    def updateVideoPos(self):
+        # the capture object is ahead of us while the reader is running
+        if self.reader is None:
+            super(bsubPlayer, self).updateVideoPos()
+    
+    def beginning(self):
+        self.stopReader()
+        super(bsubPlayer, self).beginning()
+    
+    def jumpToFrame(self, tbPos):
+        if tbPos != self.posFrames:
+            self.stopReader()
+            super(bsubPlayer, self).jumpToFrame(tbPos)
+    
+    def quit(self, key=None):
+        self.stopReader()
+        super(bsubPlayer, self).quit(key)
+        
     def startBackSub(self):
-        #self.backSub = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
-        self.backSub = cv2.createBackgroundSubtractorKNN(detectShadows=False)
+        if self.useCuda and not (hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0):
+            print("No CUDA device available to OpenCV, using the CPU for background subtraction.")
+            self.useCuda = False
+        if self.useCuda:
+            self.stream = cv2.cuda_Stream()
+            self.gpuFrame = cv2.cuda_GpuMat()
+            self.backSub = cv2.cuda.createBackgroundSubtractorMOG2(history=self.history, varThreshold=self.varThreshold, detectShadows=False)
+        else:
+            #self.backSub = cv2.createBackgroundSubtractorKNN(detectShadows=False)
+            self.backSub = cv2.createBackgroundSubtractorMOG2(history=self.history, varThreshold=self.varThreshold, detectShadows=False)
+            self.backSub.setNMixtures(3)
         
     def getForegroundMask(self):
-        return self.backSub.apply(self.img)
+        """Get the foreground mask (left on the device as a GpuMat when using CUDA)."""
+        if self.useCuda:
+            self.gpuFrame.upload(self.img, self.stream)
+            self.gpuMask = self.backSub.apply(self.gpuFrame, -1, self.stream)
+            return self.gpuMask
+        if self.scale != 1.0:
+            small = cv2.resize(self.img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            self.smallMask = self.backSub.apply(small, self.smallMask)
+            return cv2.resize(self.smallMask, (self.img.shape[1], self.img.shape[0]), self.fgmask, interpolation=cv2.INTER_NEAREST)
+        # reuse the mask buffer from the last frame
+        return self.backSub.apply(self.img, self.fgmask)
         
     def getForegroundFrame(self):
         self.fgmask = self.getForegroundMask()
-        return cv2.bitwise_and(self.img, self.img, mask=self.fgmask)
+        if self.useCuda:
+            # mask on the device and only download the result
+            gpuFg = cv2.cuda.bitwise_and(self.gpuFrame, self.gpuFrame, mask=self.gpuMask, stream=self.stream)
+            fgimg = gpuFg.download(self.stream)
+            self.stream.waitForCompletion()
+            return fgimg
+        # copy the foreground pixels into a buffer we keep between frames
+        if self.fgframe is None or self.fgframe.shape != self.img.shape:
+            self.fgframe = np.empty_like(self.img)
+        if njit is not None and self.img.ndim == 3:
+            maskFrame(self.img, self.fgmask, self.fgframe)
+        else:
+            # cv2 also handles grayscale frames (maskFrame only works on color ones)
+            self.fgframe.fill(0)
+            cv2.copyTo(self.img, self.fgmask, self.fgframe)
+        return self.fgframe
+    
+    def getBackgroundImage(self):
+        if self.useCuda:
+            bgimg = self.backSub.getBackgroundImage(self.stream).download(self.stream)
+            self.stream.waitForCompletion()
+            return bgimg
+        bgimg = self.backSub.getBackgroundImage()
+        if self.scale != 1.0:
+            bgimg = cv2.resize(bgimg, (self.img.shape[1], self.img.shape[0]))
+        return bgimg
     
     def drawExtra(self):
         #self.img = self.getForegroundFrame()
         self.fgimg = self.getForegroundFrame()
-        self.img = self.backSub.getBackgroundImage()
+        self.img = self.getBackgroundImage()
     
 # Entry point
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simple test of background extraction.")
     parser.add_argument('videoFilename', help="Name of the video file to play.")
+    parser.add_argument('-c', '--cuda', dest='useCuda', action='store_true', help="Run background subtraction on the GPU (requires OpenCV built with CUDA).")
+    parser.add_argument('-s', '--scale', dest='scale', type=float, default=1.0, help="Factor to scale frames by before background subtraction (e.g. 0.5 to use half resolution, faster but coarser). Not used with --cuda.")
+    parser.add_argument('--max-latency-ms', dest='maxLatency', type=float, help="Drop frames when background subtraction falls more than this many milliseconds of video behind (default: never drop frames).")
+    parser.add_argument('--history', dest='history', type=int, default=200, help="Number of frames of history for the MOG2 background model (default: %(default)s).")
+    parser.add_argument('--var-threshold', dest='varThreshold', type=float, default=16, help="MOG2 variance threshold for deciding if a pixel is foreground (default: %(default)s).")
     args = parser.parse_args()
     videoFilename = args.videoFilename
 
-    player = bsubPlayer(videoFilename)
+    player = bsubPlayer(videoFilename, useCuda=args.useCuda, scale=args.scale, maxLatency=args.maxLatency, history=args.history, varThreshold=args.varThreshold)
     player.play()
     player.pause()
     #player.playInThread()
@@ -5,7 +5,6 @@
 import os, sys, time, argparse, traceback
 import threading
 import random
-import rlcompleter, readline
 import numpy as np
 import cv2
 from cvguipy import cvgui, cvhomog, cvgeom
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import os, sys, subprocess
+import os, sys, subprocess, shutil, tempfile
+import io
 import argparse
 import subprocess
 import threading
@@ -8,7 +9,7 @@ import timeit
 from random import random, randint
 import numpy as np
 from configobj import ConfigObj
-from cvguipy import cvconfig
+from cvguipy import cvconfig, trajstorage
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="create combination of datasets (sqlite(s)) with a range of configuration")
@@ -17,6 +18,18 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--homography-file', dest='homography', required = True, help= "Name of the homography file for cvplayer.")
     parser.add_argument('-t', '--configuration-file', dest='range_cfg', help= "the configuration-file contain the range of configuration")
     parser.add_argument('-m', '--mask-File', dest='maskFilename', help="Name of the mask-File for trajextract")
+    parser.add_argument('--dump-configs', dest='dumpConfigs', action='store_true', help="Write each configuration to a file in cfg_files/ instead of piping it to trajextract.py")
+    parser.add_argument('--single-db', dest='singleDB', action='store_true', help="Merge the results into the single database sql_files/results.sqlite (features stored once, object tables prefixed with id<ID>) instead of keeping one database per ID")
+    parser.add_argument('--sync', action='store_true', help="Flush the copied databases (and cfg files) to disk before running the grouping stage")
+    parser.add_argument('-x', '--exe-path', dest='exePath', default='feature-based-tracking', help="Location of the TrafficIntelligence binary feature-based-tracking used for the feature grouping (defaults to 'feature-based-tracking' in the user's $PATH)")
+    parser.add_argument('--use-trajextract', dest='useTrajextract', action='store_true', help="Run the feature grouping for each ID through trajextract.py instead of running feature-based-tracking directly")
+    parser.add_argument('--compare', choices=['none', 'brute', 'genetic'], default='none', help="Compare all the data sets to the annotations when they are done, with compare.py (brute) or genetic_compare.py (genetic) (default: %(default)s)")
+    parser.add_argument('-md', '--matching-distance', dest='matchDistance', type=float, default=10, help="Matching distance for the comparison (default: %(default)s)")
+    parser.add_argument('--population', type=int, default=20, help="Population for the genetic comparison (default: %(default)s)")
+    parser.add_argument('--num-parents', dest='numParents', type=int, default=3, help="Number of parents selected each generation for the genetic comparison (default: %(default)s)")
+    parser.add_argument('--accuracy', type=int, default=5, help="Number of generations without improvement before stopping the genetic comparison (default: %(default)s)")
+    parser.add_argument('--interactive', action='store_true', help="Ask whether (and how) to compare the data sets to the annotations when they are done")
+    parser.add_argument('-n', '--nprocess', type=int, dest='nProcess', help="Maximum number of trajextract processes to run at the same time (default: number of CPUs)")
     args = parser.parse_args()
 
     # inputVideo check
@@ -43,14 +56,15 @@ if __name__ == '__main__':
             sys.exit(1)
         else:
             videofile=args.inputVideo
-            if 'avi' in videofile:
+            videoName, videoExt = os.path.splitext(videofile)
+            if videoExt.lower() == '.avi':
                 if args.maskFilename is not None:
                     command = ['trajextract.py',args.inputVideo,'-m', args.maskFilename,'-o', args.homography]
                 else:
                     command = ['trajextract.py',args.inputVideo,'-o', args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
-                databaseFile = videofile.replace('avi','sqlite')
+                databaseFile = videoName + '.sqlite'
                 command = ['cvplayer.py',args.inputVideo,'-d',databaseFile,'-o',args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
@@ -65,64 +79,99 @@ if __name__ == '__main__':
      
     config_files = "cfg_files/Cfg_ID_"
     sqlite_files = "sql_files/Sqlite_ID_"
-    os.mkdir('cfg_files')
+    results_file = "sql_files/results.sqlite"
+    if args.dumpConfigs:
+        os.mkdir('cfg_files')
     os.mkdir('sql_files')
     thread_cfgtolist.join();
+    cfg_list = cvconfig.CVConfigTable.from_list(cfg_list)
     combination = cfg_list.get_total_combination()
+    cfg_indices = cfg_list.get_indices(np.arange(combination))
 
-    # create all combnation of cfg files and cp databaseFile
-    process = []
-    for ID in range(0,combination):
-        cfg_name = config_files + str(ID) + '.cfg'
-        sql_name = sqlite_files + str(ID) + '.sqlite'
-        
-        open(cfg_name,'w').close()
-        config = ConfigObj(cfg_name)
-        cfg_list.write_config(ID,config)
-        if ID == 0:
-            # create one tracking_feature_only sqlite
-            print("creating the first tracking only database template.")
-            if args.maskFilename is not None:
-                command = ['trajextract.py',args.inputVideo, '-d', sql_name, '-t', cfg_name, '-o', args.homography, '-m', args.maskFilename, '--tf']
-            else:
-                command = ['trajextract.py',args.inputVideo, '-d', sql_name, '-t', cfg_name, '-o', args.homography, '--tf']
-            p = subprocess.Popen(command)
-            p.wait()
-            tf_dbfile = sql_name
-        else :
-            # duplicate the tracking_feature_only sqlite for every ID
-            command = ['cp',tf_dbfile,sql_name]
-            process.append(subprocess.Popen(command))
-    cvconfig.wait_all_subproccess(process);
+    # create all combnation of cfgs
+    # (unless --dump-configs is given, cfgs are kept in memory and sent to trajextract on stdin,
+    # which is only needed for the first one if the grouping runs feature-based-tracking directly)
+    if args.dumpConfigs:
+        cfg_names = [config_files + str(ID) + '.cfg' for ID in range(0,combination)]
+        cvconfig.write_all_configs(cfg_list, cfg_names, cfg_indices)
+        cfg_data = [None] * combination
+    else:
+        cfg_names = ['-'] * combination
+        cfg_data = []
+        for ID in range(0,combination if args.useTrajextract else 1):
+            cfg_buffer = io.BytesIO()
+            cfg_list.write_config_indices(cfg_indices[ID],ConfigObj(),cfg_buffer)
+            cfg_data.append(cfg_buffer.getvalue())
+    
+    # create one tracking_feature_only sqlite and copy it for every ID
+    print("creating the first tracking only database template.")
+    tf_dbfile = sqlite_files + '0.sqlite'
+    if args.maskFilename is not None:
+        command = ['trajextract.py',args.inputVideo, '-d', tf_dbfile, '-t', cfg_names[0], '-o', args.homography, '-m', args.maskFilename, '--tf']
+    else:
+        command = ['trajextract.py',args.inputVideo, '-d', tf_dbfile, '-t', cfg_names[0], '-o', args.homography, '--tf']
+    cvconfig.run_subprocess(command, cfg_data[0])
+    # duplicate the tracking_feature_only sqlite for every other ID (copied in-kernel, no need to run cp)
+    cvconfig.copy_file_to_all(tf_dbfile, [sqlite_files + str(ID) + '.sqlite' for ID in range(1,combination)])
+    if args.sync:
+        sync_names = [sqlite_files + str(ID) + '.sqlite' for ID in range(0,combination)]
+        if args.dumpConfigs:
+            sync_names += cfg_names
+        cvconfig.sync_all_files(sync_names)
 
-    # run trajextract(grouping feature) on all sqlites that contain only tracking feature
-    process = []
-    for ID in range(0,combination):
-        cfg_name = config_files +str(ID)+'.cfg'
-        sql_name = sqlite_files +str(ID)+'.sqlite'
-        command = ['trajextract.py', args.inputVideo, '-o', args.homography, '-t',cfg_name, '-d', sql_name, '--gf']
-        process.append(subprocess.Popen(command))
-    cvconfig.wait_all_subproccess(process);
+    # run the feature grouping on all sqlites that contain only tracking feature
+    # (trajextract.py is only a wrapper around feature-based-tracking, so by default the
+    # binary is run directly and Python doesn't have to start up again for every ID)
+    tmp_cfg_dir = None
+    if args.useTrajextract:
+        grouping = 'trajextract.py --gf'
+        commands = [['trajextract.py', args.inputVideo, '-o', args.homography, '-t', cfg_names[ID], '-d', sqlite_files + str(ID) + '.sqlite', '--gf'] for ID in range(0,combination)]
+        grouping_data = cfg_data
+    else:
+        grouping = args.exePath + ' --gf'
+        grouping_cfgs = cfg_names
+        if not args.dumpConfigs:
+            # feature-based-tracking needs cfg files, so put them in a temporary directory (in memory if possible)
+            tmp_cfg_dir = tempfile.mkdtemp(prefix='cfg_combination_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            grouping_cfgs = [os.path.join(tmp_cfg_dir, 'Cfg_ID_' + str(ID) + '.cfg') for ID in range(0,combination)]
+            cvconfig.write_all_configs(cfg_list, grouping_cfgs, cfg_indices)
+        commands = [[args.exePath, '--config-file', grouping_cfgs[ID], '--homography-filename', args.homography, '--video-filename', args.inputVideo, '--database-filename', sqlite_files + str(ID) + '.sqlite', '--gf'] for ID in range(0,combination)]
+        grouping_data = None
+    returncodes = cvconfig.run_all_subprocess(commands, args.nProcess, grouping_data)
+    if tmp_cfg_dir is not None:
+        shutil.rmtree(tmp_cfg_dir)
+    failed = [ID for ID, rc in enumerate(returncodes) if rc != 0]
+    if len(failed) > 0:
+        print("{} failed for IDs: {}".format(grouping, failed))
+    if args.singleDB:
+        print("merging the results into {} ...".format(results_file))
+        trajstorage.mergeGroupingResults([sqlite_files + str(ID) + '.sqlite' for ID in range(0,combination)], results_file, ['id' + str(ID) for ID in range(0,combination)])
     
     stop = timeit.default_timer()
     print("cfg_edit has successful create "+ str(combination) +" of data sets in " + str(stop - start))
     
-    decision = raw_input('Do you want to compare all combination of data sets to ground truth(Annotaion)? [Y/N]\n')
-    if decision == "Y" or decision == "y":
-        algorithm = raw_input('Which algorithm do you want to use for comparison? (Genetic: G, BruteForce: B)')
-        while algorithm != 'G' and algorithm != 'B':
-            print("invalid input......")
-            algorithm = raw_input('Which algorithm do you want to use for comparison? (Genetic: G, BruteForce: B)')
-        if algorithm == 'B':
-            command = ['compare.py', '-d', databaseFile, '-o', args.homography, '-md', '10', '-f', '0', '-l', str(combination-1)];
-            process = subprocess.Popen(command)
-            process.wait()
-        if algorithm == 'G':
-            print("Now...enter require parameter for genetic algorithm")
-            population = raw_input('Population: ')
-            num_parent = raw_input('Number of parents selected each generation: ')
-            accuracy = raw_input('Accuracy (Number of step to stop if no improvement): ')
-            command = ['genetic_compare.py', '-d', args.databaseFile, '-o', args.homography, '-a', accuracy, '-p', population, '-np', num_parent]
-            process = subprocess.Popen(command)
-            
-            
+    if args.interactive:
+        decision = input('Do you want to compare all combination of data sets to ground truth(Annotaion)? [Y/N]\n')
+        if decision == "Y" or decision == "y":
+            algorithm = input('Which algorithm do you want to use for comparison? (Genetic: G, BruteForce: B)')
+            while algorithm != 'G' and algorithm != 'B':
+                print("invalid input......")
+                algorithm = input('Which algorithm do you want to use for comparison? (Genetic: G, BruteForce: B)')
+            if algorithm == 'B':
+                args.compare = 'brute'
+            if algorithm == 'G':
+                args.compare = 'genetic'
+                print("Now...enter require parameter for genetic algorithm")
+                args.population = int(input('Population: '))
+                args.numParents = int(input('Number of parents selected each generation: '))
+                args.accuracy = int(input('Accuracy (Number of step to stop if no improvement): '))
+    
+    if args.compare == 'brute':
+        command = ['compare.py', '-d', databaseFile, '-o', args.homography, '-md', str(args.matchDistance), '-f', '0', '-l', str(combination-1)]
+        sys.exit(subprocess.run(command).returncode)
+    elif args.compare == 'genetic':
+        if args.singleDB:
+            print("genetic_compare.py needs one database per ID, it can't be used with --single-db! Exiting...")
+            sys.exit(1)
+        command = ['genetic_compare.py', '-d', databaseFile, '-o', args.homography, '-md', str(args.matchDistance), '-a', str(args.accuracy), '-p', str(args.population), '-np', str(args.numParents)]
+        sys.exit(subprocess.run(command).returncode)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import sys, argparse
+import numpy as np
+from cvguipy import cvmoving
+from cvguipy.cvmoving import moving
+
+"""Check that cvmoving.computeClearMOT gives the same CLEAR MOT metrics as moving.computeClearMOT (TrafficIntelligence) on random trajectories."""
+
+def randomWalk(rng, nPoints, scale=2.):
+    """Random walk of nPoints points starting somewhere in a 100x100 area."""
+    return rng.uniform(0, 100, size=2) + np.cumsum(rng.normal(scale=scale, size=(nPoints, 2)), axis=0)
+
+def makeObject(num, first, xy):
+    return moving.MovingObject(num, timeInterval=moving.TimeInterval(first, first+len(xy)-1), positions=moving.Trajectory([xy[:,0].tolist(), xy[:,1].tolist()]))
+
+def randomScene(rng, nFrames, nAnnotations, nFalse, noise):
+    """
+    Make random annotations and tracked objects for them: each annotation is
+    tracked (with noise) over part of its life, sometimes as two objects (to
+    cause mismatches), and nFalse objects are not near any annotation.
+    """
+    annotations, objects = [], []
+    for k in range(nAnnotations):
+        first = int(rng.integers(0, nFrames-2))
+        last = int(rng.integers(first+1, nFrames))
+        xy = randomWalk(rng, last-first+1)
+        annotations.append(makeObject(k, first, xy))
+
+        # track it from a random instant to a random instant, splitting the track in two sometimes
+        s = int(rng.integers(0, len(xy)))
+        e = int(rng.integers(s, len(xy)))
+        tracked = xy[s:e+1] + rng.normal(scale=noise, size=(e-s+1, 2))
+        splits = [0, int(rng.integers(1, len(tracked)))] if len(tracked) > 1 and rng.random() < 0.3 else [0]
+        for a, b in zip(splits, splits[1:] + [len(tracked)]):
+            objects.append(makeObject(len(objects), first+s+a, tracked[a:b]))
+    for k in range(nFalse):
+        first = int(rng.integers(0, nFrames-2))
+        last = int(rng.integers(first+1, nFrames))
+        objects.append(makeObject(len(objects), first, randomWalk(rng, last-first+1)))
+    return annotations, objects
+
+def sameMetrics(m1, m2):
+    """Check the metrics are the same (motp is a float sum, so it is compared with a tolerance)."""
+    motp1, motp2 = m1[0], m2[0]
+    if (motp1 is None) != (motp2 is None) or (motp1 is not None and not np.isclose(motp1, motp2)):
+        return False
+    if (m1[1] is None) != (m2[1] is None) or (m1[1] is not None and not np.isclose(m1[1], m2[1])):
+        return False
+    return tuple(m1[2:]) == tuple(m2[2:])
+
+# Entry point
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that cvmoving.computeClearMOT matches moving.computeClearMOT on random trajectories.")
+    parser.add_argument('-n', '--n-scenes', dest='nScenes', type=int, default=20, help="Number of random scenes to check.")
+    parser.add_argument('-f', '--n-frames', dest='nFrames', type=int, default=300, help="Number of frames in each scene.")
+    parser.add_argument('-w', '--windows', dest='windows', type=int, nargs='+', default=[1, 7, 64, 256, 1000], help="Window sizes to check cvmoving.computeClearMOT with.")
+    parser.add_argument('-m', '--matching-distance', dest='matchDistance', type=float, default=5, help="Matching distance for computing tracking performance.")
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=0, help="Seed for the random number generator.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    nFailed = 0
+    for i in range(args.nScenes):
+        annotations, objects = randomScene(rng, args.nFrames, nAnnotations=int(rng.integers(1, 15)), nFalse=int(rng.integers(0, 10)), noise=float(rng.uniform(0.5, 4.)))
+        reference = moving.computeClearMOT(annotations, objects, args.matchDistance, 0, args.nFrames-1)
+        for window in args.windows:
+            metrics = cvmoving.computeClearMOT(annotations, objects, args.matchDistance, 0, args.nFrames-1, window=window)
+            if not sameMetrics(reference, metrics):
+                nFailed += 1
+                print("Scene {} with window {}: got {}, expected {}".format(i, window, metrics, reference))
+
+    nChecks = args.nScenes*len(args.windows)
+    print("{} of {} checks passed".format(nChecks-nFailed, nChecks))
+    sys.exit(1 if nFailed > 0 else 0)
@@ -4,7 +4,7 @@ import os, sys, argparse
 import numpy as np
 from tabulate import tabulate
 import moving
-from cvguipy import cvgui, trajstorage
+from cvguipy import cvgui, trajstorage, cvmoving, cvhomog
 
 # Entry point
 if __name__ == "__main__":
@@ -14,16 +14,12 @@ if __name__ == "__main__":
     parser.add_argument('-a', '--annotation-file', dest='annotationFile', help="Name of the database file containing annotations.", required=True)
     parser.add_argument('-t', '--annotation-table', dest='annotationTable', help="Name of the table in the annotation database. If not specified, the latest table is used.")
     parser.add_argument('-m', '--matching-distance', dest='matchDistance', type=float, default=10, help="Matching distance for computing tracking performance.")
+    parser.add_argument('--no-cache', dest='noCache', action='store_true', help="Do not use (or create) the annotation cache.")
     args = parser.parse_args()
     
     # open the annotation database and load the homography
     adb = trajstorage.CVsqlite(args.annotationFile)
-    hom = np.loadtxt(args.homography)
-    
-    # NOTE This method of inverting the homography leaves out the conversion
-    # from homogeneous coordinates (i.e. dividing by w), but it matches 
-    # TrafficIntelligence. It works, but should look into it sometime.
-    invHom = np.linalg.inv(hom)
+    hom, invHom = cvhomog.loadHomography(args.homography)
     
     if args.annotationTable is None:
         # if no table name specified, get the latest annotations in the database
@@ -36,29 +32,25 @@ if __name__ == "__main__":
             print("Table '{}' does not exist! Exiting!".format(annotationTable))
             sys.exit(1)
     
-    # build the bounding box table for the annotations and load them, computing
-    # the centroid trajectory too
+    # load the annotations with their centroid trajectories (from the cache if
+    # they were already computed for this table and homography) and the first
+    # and last frame numbers of the annotations
     print("Using annotations in table {} ...".format(annotationTable))
-    adb.createBoundingBoxTable(annotationTable, invHom)
-    adb.loadAnnotations()
-    for a in adb.annotations:
-        a.computeCentroidTrajectory(hom)
-    
-    # get the first and last frame numbers of the annotations
-    frameNums = adb.getFrameList()
-    firstFrame = frameNums[0]
-    lastFrame = frameNums[-1]
+    cacheDir = None if args.noCache else trajstorage.ANNOTATION_CACHE_DIR
+    annotationArrays, firstFrame, lastFrame = adb.loadAnnotationArrays(hom, annotationTable, cacheDir, invHom)
+    annotations = trajstorage.annotationsFromArrays(annotationArrays)
     
     # loop over the databases and compute performance
     clearMOT = []
     for dbf in args.databaseFilename:
         # open the database and load the trajectories
         print("Loading objects from database {} ...".format(dbf))
-        db = trajstorage.CVsqlite(dbf)
-        db.loadObjects()
+        db = trajstorage.CVsqlite(dbf, tuned=True, readOnce=True)
+        db.loadObjects(frameRange=(firstFrame, lastFrame))
+        db.close()
         
         # compute CLEAR MOT metrics
-        motp, mota, mt, mme, fpt, gt = moving.computeClearMOT(adb.annotations, db.objects, args.matchDistance, firstFrame, lastFrame)
+        motp, mota, mt, mme, fpt, gt = cvmoving.computeClearMOT(annotations, db.objects, args.matchDistance, firstFrame, lastFrame)
         
         # store results in a list of lists
         clearMOT.append([dbf, mota, motp, mt, mme, fpt, gt])
@@ -3,35 +3,96 @@
 import os, sys, subprocess
 import argparse
 import subprocess
-from multiprocessing import Process, Lock, Queue
+from multiprocessing import Pool, get_context
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.managers import SharedMemoryManager
 import timeit
-from time import sleep
 import psutil
-from numpy import loadtxt
-from numpy.linalg import inv
-import matplotlib.pyplot as plt
-import moving
-from cvguipy import trajstorage, cvgenetic
+import numpy as np
+from cvguipy import trajstorage, cvmoving, cvhomog
 
 """ compare all precreated sqlite (by cfg_combination.py) with annotated version using brute force """
 
-def computeMOT(i, lock, printlock, motalist, IDlist) :
-    obj = trajstorage.CVsqlite(sqlite_files+str(i)+".sqlite")
-    obj.loadObjects()
+# data shared by every ID, set once in each worker process by initWorker
+workerData = None
+workerShm = None
+workerDB = None
+
+def shareAnnotations(arrays, smm):
+    """
+    Put the annotation arrays (from trajstorage.annotationsToArrays) in a shared
+    memory block from the SharedMemoryManager smm (which frees it when it shuts
+    down). Returns the SharedMemory object and the layout needed to attach to it.
+    """
+    layout = []
+    size = 0
+    for name, a in arrays.items():
+        layout.append((name, size, a.shape, a.dtype.str))
+        size += a.nbytes
+    shm = smm.SharedMemory(size=max(size, 1))
+    for name, offset, shape, dtype in layout:
+        np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[:] = arrays[name]
+    return shm, layout
+
+def attachAnnotations(shmName, layout):
+    """Attach to the shared annotation arrays (no copy) and return the SharedMemory object and the arrays."""
+    shm = SharedMemory(name=shmName)
+    arrays = {name: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for name, offset, shape, dtype in layout}
+    return shm, arrays
+
+def initWorker(shmName, layout, sqliteFiles, resultsFile, matchDistance, firstFrame, lastFrame):
+    """
+    Attach to the shared annotations and store the data needed for every ID in
+    the worker process (so it is built once per worker, not sent once per ID).
+    If resultsFile is given, it is opened once and used for every ID.
+    """
+    global workerData, workerShm, workerDB
+    if resultsFile is not None:
+        workerDB = trajstorage.CVsqlite(resultsFile, tuned=True, readOnce=True)
+    workerShm, arrays = attachAnnotations(shmName, layout)
+    # computeClearMOT works on objects, so build lightweight ones from the shared arrays once
+    annotations = trajstorage.annotationsFromArrays(arrays)
+    workerData = (annotations, sqliteFiles, matchDistance, firstFrame, lastFrame)
+
+def computeMOT(i):
+    annotations, sqliteFiles, matchDistance, firstFrame, lastFrame = workerData
+    if workerDB is not None:
+        # all IDs are in one database (cfg_combination.py --single-db)
+        workerDB.loadObjects(objTablePrefix='id'+str(i), frameRange=(firstFrame, lastFrame))
+        objects = workerDB.objects
+    else:
+        obj = trajstorage.CVsqlite(sqliteFiles+str(i)+".sqlite", tuned=True, readOnce=True)
+        obj.loadObjects(frameRange=(firstFrame, lastFrame))
+        objects = obj.objects
+        obj.close()
     
-    motp, mota, mt, mme, fpt, gt = moving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
-    lock.acquire()
-    IDlist.put(i)
-    motalist.put(mota)
-    obj.close()
-    lock.release()
+    motp, mota, mt, mme, fpt, gt = cvmoving.computeClearMOT(annotations, objects, matchDistance, firstFrame, lastFrame)
+    return i, mota
+
+def plotMOTA(foundmota, IDs, bestMota, bestID, lastID, outfile=None):
+    """Plot the calculated MOTA with its IDs, saving it to outfile (or showing it if outfile is None)."""
+    import matplotlib
+    if outfile is not None:
+        # no GUI needed to write a file
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.plot(foundmota ,IDs ,'bo')
+    plt.plot(bestMota, bestID, 'ro')
+    plt.axis([-1, 1, -1, lastID+1])
+    plt.xlabel('mota')
+    plt.ylabel('ID')
     
-    printlock.acquire()
-    if args.PrintMOTA:
-        print("Done ID ----- ", i, "With MOTA:", mota)
+    plt.title('Best MOTA: '+str(bestMota) +'\nwith ID: '+str(bestID))
+    if outfile is not None:
+        plt.savefig(outfile, dpi=120)
+        plt.close()
     else:
-        print("Done ID ----- ", i)
-    printlock.release()
+        plt.show()
+
+def getNumWorkers(ramPercent, workerMemory):
+    """Number of workers that fit in ramPercent of the total RAM if each uses workerMemory MB (at most one per CPU)."""
+    ramBudget = psutil.virtual_memory().total * ramPercent / 100.0
+    return max(1, min(os.cpu_count(), int(ramBudget / (workerMemory * 1024 * 1024))))
     
 if __name__ == '__main__' :
     parser = argparse.ArgumentParser(description="compare all sqlites that are created by cfg_combination.py to the Annotated version to find the ID of the best configuration")
@@ -41,56 +102,44 @@ if __name__ == '__main__' :
     parser.add_argument('-l', '--Last-ID', dest ='lastID', help = "the last ID of the range of ID", required = True, type = int)
     parser.add_argument('-md', '--matching-distance', dest='matchDistance', help = "matchDistance", default = 10, type = float)
     parser.add_argument('-mota', '--print-MOTA', dest='PrintMOTA', action = 'store_true', help = "Print MOTA for each ID.")
-    parser.add_argument('-ram', '--RAM-monitor', dest='RAMMonitor', help = "parameter for ram_monitor", default = 50, type = float)
-    parser.add_argument('-bm', '--block-monitor', dest='BlockMonitor', action = 'store_true', help = "Block RamMonitor")
+    parser.add_argument('-ram', '--RAM-monitor', dest='RAMMonitor', help = "Percentage of the total RAM the worker processes may use (used to pick the number of workers)", default = 50, type = float)
+    parser.add_argument('-wm', '--worker-memory', dest='workerMemory', help = "Estimated memory used by one worker process, in MB", default = 500, type = float)
+    parser.add_argument('-bm', '--block-monitor', dest='BlockMonitor', action = 'store_true', help = "Block RamMonitor (use one worker per CPU)")
+    parser.add_argument('-n', '--nprocess', dest='nProcess', help = "Number of worker processes (overrides the RAM monitor)", type = int)
+    parser.add_argument('--plot', action = 'store_true', help = "Show the MOTA plot in a window instead of saving it to a file")
+    parser.add_argument('--plot-file', dest='plotFile', help = "File to save the MOTA plot to (default: %(default)s)", default = 'mota_sweep.png')
+    parser.add_argument('--no-cache', dest='noCache', action = 'store_true', help = "Do not use (or create) the annotation cache")
     args = parser.parse_args()
     dbfile = args.databaseFile;
-    homography = loadtxt(args.homography)
+    homography, invHomography = cvhomog.loadHomography(args.homography)
     sqlite_files = "sql_files/Sqlite_ID_"
+    results_file = "sql_files/results.sqlite"
+    if not os.path.exists(results_file):
+        results_file = None
     
     start = timeit.default_timer()
     
     cdb = trajstorage.CVsqlite(dbfile)
-    cdb.open()
     cdb.getLatestAnnotation()
-    cdb.createBoundingBoxTable(cdb.latestannotations, inv(homography))
-    cdb.loadAnnotaion()
-    for a in cdb.annotations:
-        a.computeCentroidTrajectory(homography)
     print("Latest Annotaions in "+dbfile+": ", cdb.latestannotations)
-    # for row in cdb.boundingbox:
-    #     print(row)
-    cdb.frameNumbers = cdb.getFrameList()
-    firstFrame = cdb.frameNumbers[0]
-    lastFrame = cdb.frameNumbers[-1]
+    annotationArrays, firstFrame, lastFrame = cdb.loadAnnotationArrays(homography, cdb.latestannotations, None if args.noCache else trajstorage.ANNOTATION_CACHE_DIR, invHomography)
     
-    foundmota = Queue()
-    IDs = Queue()
-    processes = []
-    lock = Lock()
-    printlock = Lock()
-    # printlock.acquire()
-    # TODO NOTE - this is a workaround until we can find a better way to monitor RAM usage
-    for i in range(args.firstID,args.lastID + 1):
-        while (not args.BlockMonitor) and psutil.virtual_memory()[2] > args.RAMMonitor:
-            # print(psutil.virtual_memory()[2])
-            sleep(2)
-        print("Analyzing ID ", i)
-        p = Process(target = computeMOT, args = (i, lock, printlock, foundmota, IDs,))
-        processes.append(p)
-        p.start()
-        if (not args.BlockMonitor) and i%20 == 0 and i != 0:
-            # print(psutil.virtual_memory()[2])
-            sleep(5)
-        if (not args.BlockMonitor) and psutil.virtual_memory()[2] > 20:
-            sleep(1)
-    # printlock.release()
-    for p in processes:
-        p.join()
-        
-    # transform queue to lists
-    foundmota = cvgenetic.Queue_to_list(foundmota)
-    IDs = cvgenetic.Queue_to_list(IDs)
+    foundmota = []
+    IDs = []
+    nProcess = args.nProcess
+    if nProcess is None and not args.BlockMonitor:
+        nProcess = getNumWorkers(args.RAMMonitor, args.workerMemory)
+    print("Analyzing IDs {} to {} with {} processes".format(args.firstID, args.lastID, nProcess if nProcess is not None else os.cpu_count()))
+    with SharedMemoryManager() as smm:
+        shm, layout = shareAnnotations(annotationArrays, smm)
+        with Pool(nProcess, initWorker, (shm.name, layout, sqlite_files, results_file, args.matchDistance, firstFrame, lastFrame)) as pool:
+            for i, mota in pool.imap_unordered(computeMOT, range(args.firstID,args.lastID + 1), chunksize=8):
+                IDs.append(i)
+                foundmota.append(mota)
+                if args.PrintMOTA:
+                    print("Done ID ----- ", i, "With MOTA:", mota)
+                else:
+                    print("Done ID ----- ", i)
     
     Best_mota = max(foundmota)
     Best_ID = IDs[foundmota.index(Best_mota)]
@@ -99,14 +148,17 @@ if __name__ == '__main__' :
     stop = timeit.default_timer()
     print(str(stop-start) + "s")
     
-    # use matplot to print calculated mota with its ids
-    plt.plot(foundmota ,IDs ,'bo')
-    plt.plot(Best_mota, Best_ID, 'ro')
-    plt.axis([-1, 1, -1, args.lastID+1])
-    plt.xlabel('mota')
-    plt.ylabel('ID')
-    
-    plt.title(b'Best MOTA: '+str(Best_mota) +'\nwith ID: '+str(Best_ID))
-    plt.show()
+    if not args.plot:
+        plotMOTA(foundmota, IDs, Best_mota, Best_ID, args.lastID, args.plotFile)
+        print("MOTA plot saved to", args.plotFile)
+        cdb.close()
+        sys.exit(0)
     
+    # show the plot from a separate (spawned) process so this one can exit and
+    # release the trajectory memory while the plot window is open
+    plotter = get_context('spawn').Process(target=plotMOTA, args=(foundmota, IDs, Best_mota, Best_ID, args.lastID))
+    plotter.start()
     cdb.close()
+    sys.stdout.flush()
+    # os._exit skips the multiprocessing exit handler, which would wait for the plot window to be closed
+    os._exit(0)
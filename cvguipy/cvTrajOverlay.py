@@ -1,11 +1,50 @@
 #!/usr/bin/python
 """Classes and functions for interactively visualizing trajectory data, particularly for optimizing configuration and training data."""
 
-import os, sys, time, traceback
+import os, sys, time, traceback, threading
 import numpy as np
 import cv2
+import shapely.geometry, shapely.prepared
 from . import trajstorage, cvmoving, cvgui, cvhomog, cvgeom
 
+# numba is optional, if available it is used to draw all the trajectories in one call
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def drawPolylines(img, pts, offsets, colors):
+        """
+        Draw each polyline pts[offsets[k]:offsets[k+1]] on img in colors[k]
+        as 8-connected (Bresenham) lines, like cv2.polylines with the default
+        lineType. The polylines are drawn in order (like separate cv2.polylines
+        calls) so where they cross the last one drawn is on top.
+        """
+        h, w, c = img.shape
+        for k in range(offsets.shape[0]-1):
+            for i in range(offsets[k]+1, offsets[k+1]):
+                x0, y0 = pts[i-1,0], pts[i-1,1]
+                x1, y1 = pts[i,0], pts[i,1]
+                dx, dy = abs(x1 - x0), -abs(y1 - y0)
+                sx = 1 if x0 < x1 else -1
+                sy = 1 if y0 < y1 else -1
+                err = dx + dy
+                while True:
+                    if x0 >= 0 and x0 < w and y0 >= 0 and y0 < h:
+                        for j in range(c):
+                            img[y0,x0,j] = colors[k,j]
+                    if x0 == x1 and y0 == y1:
+                        break
+                    e2 = 2*err
+                    if e2 >= dy:
+                        err += dy
+                        x0 += sx
+                    if e2 <= dx:
+                        err += dx
+                        y0 += sy
+
 class ObjectJoiner(cvgui.action):
     """An action for joining a list of objects."""
     def __init__(self, objList, drawObjectList):
@@ -16,12 +55,10 @@ class ObjectJoiner(cvgui.action):
         
     def do(self):
         """Join all objects in the list by cross-joining all objects."""
-        # join all the objects
-        for o1 in self.objList:
-            for o2 in self.objList:
-                if o1.getNum() != o2.getNum():
-                    print( "joining {} & {}".format(o1.getNum(),o2.getNum()))
-                    o1.join(o2)
+        # join each object with all the others at once (so its trajectory is only recomputed once)
+        print("joining {}".format(self.name))
+        for o in self.objList:
+            o.joinAll(self.objList)
         # go through the joined objects to update the image objects
         for io, mo in zip(self.objList, self.drawObjectList):
             if io.drawAsJoined():
@@ -34,10 +71,8 @@ class ObjectJoiner(cvgui.action):
     
     def undo(self):
         """Undo the join by cross-unjoining all objects."""
-        for o1 in self.objList:
-            for o2 in self.objList:
-                if o1.getNum() != o2.getNum():
-                    o1.unjoin(o2)
+        for o in self.objList:
+            o.unjoinAll(self.objList)
         # go through the joined objects to update the image objects
         for io, mo in zip(self.objList, self.drawObjectList):
             if io.drawAsJoined():
@@ -152,12 +187,23 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
         
         # important variables and containers
         self.db = None
+        self.dbThread = None
+        self.dbGZfile = None
         self.hom = None
         self.invHom = None
         self.groupingObject = None
         self.cvObjects = []
         self.features = []
         self.imgObjects = []
+        self.nImgObjectsAdded = 0                   # number of imgObjects that have been added to movingObjects
+        self.nFeaturesColored = 0                   # number of features that have been given a color
+        self.imgFirsts = np.empty(0, dtype=np.int64)            # first and last instant of each of imgObjects, to find the ones
+        self.imgLasts = np.empty(0, dtype=np.int64)             # that exist in a frame without checking each one
+        self.imgOrder = np.empty(0, dtype=np.int64)             # indices of imgObjects sorted by first instant
+        self.imgSortedFirsts = np.empty(0, dtype=np.int64)      # imgFirsts in that order (for searchsorted)
+        self.imgMaxLength = 0                                   # longest object lifetime (bounds how far back an object can start)
+        self.trajLines = []                         # (points, color) of the trajectories to draw in this frame
+        self.trajArena = np.empty((0, 2), dtype=np.int32)       # reused buffer the trajectory points are packed into for drawing
         self.lanes = None
         
         # key/mouse bindings
@@ -178,12 +224,17 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
         # disable individual/selected object hiding - it's not useful here
         # (and conflicts with how some of object annotation is implemented)
         self.disableKeyBindings(['H'])
+        
+        # pick the method for plotting objects with the current settings
+        self.setPlotLeaf()
     
     def open(self):
         """Open the video and database."""
-        # open the database first (which also loads the homography and creates the image objects)
-        # it will start loading trajectories in a separate process and return them as they are finished
-        self.openDatabase()
+        # read the homography and unzip the database in a thread so the video
+        # can be opened at the same time (inflating a gzipped database can take a while)
+        self.dbThread = threading.Thread(target=self.prepareDatabaseInThread, name='DatabasePreparer')
+        self.dbThread.daemon = True
+        self.dbThread.start()
         
         # open the mask image
         self.openMaskImage()
@@ -197,26 +248,45 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
         
         # open the video (which also sets up the trackbar)
         self.openVideo()
+        
+        # then open the database (which also creates the image objects) here, since the
+        # connection can only be used from the thread that made it, it will start loading
+        # trajectories in a separate process and return them as they are finished
+        self.dbThread.join()
+        self.openDatabase()
     
     # ### Methods for interacting with the database ###
-    def openDatabase(self):
-        """Open the database with the trajstorage.CVsqlite class, load in the objects,
-           load the homography, and create an ImageObject for each object for working
-           in image space."""
+    def prepareDatabaseInThread(self):
+        try:
+            self.prepareDatabase()
+        except:
+            print(traceback.format_exc())
+            print("Error encountered preparing database '{}' ! See above for details.".format(self.databaseFilename))
+    
+    def prepareDatabase(self):
+        """Load the homography and unzip the database (if it is gzipped) so it is ready to open."""
         if self.databaseFilename is not None and self.homographyFilename is not None:
             # read the homography if we have one
             print("Loading homography from file '{}'".format(self.homographyFilename))
             self.hom = np.loadtxt(self.homographyFilename)
             self.invHom = cvhomog.Homography.invertHomography(self.hom)
+            if os.path.splitext(self.databaseFilename)[1] == '.gz':
+                self.dbGZfile = trajstorage.GZfile(self.databaseFilename)
+    
+    def openDatabase(self):
+        """Open the database with the trajstorage.CVsqlite class, load in the objects,
+           and create an ImageObject for each object for working in image space
+           (the homography is loaded by prepareDatabase)."""
+        if self.databaseFilename is not None and self.homographyFilename is not None and self.hom is not None:
             print("Starting reader for on database '{}'".format(self.databaseFilename))
-            self.db = trajstorage.CVsqlite(self.databaseFilename, objTablePrefix=self.objTablePrefix, withFeatures=self.withFeatures, homography=self.hom, invHom=self.invHom, withImageBoxes=self.withBoxes, allFeatures=self.enableDrawAllFeatures)
+            self.db = trajstorage.CVsqlite(self.databaseFilename, objTablePrefix=self.objTablePrefix, withFeatures=self.withFeatures, homography=self.hom, invHom=self.invHom, withImageBoxes=self.withBoxes, allFeatures=self.enableDrawAllFeatures, gzdb=self.dbGZfile)
             
             if self.useAnnotations:
                 # if using annotations, get the latest annotations table
                 if self.db.getLatestAnnotation():
                     self.objTablePrefix = self.db.latestannotations.replace('objects_features', '')
                     print("Reading object groups from annotations table with prefix {} ...".format(self.objTablePrefix))
-                    self.db = trajstorage.CVsqlite(self.databaseFilename, objTablePrefix=self.objTablePrefix, withFeatures=self.withFeatures, homography=self.hom, invHom=self.invHom, withImageBoxes=self.withBoxes, allFeatures=self.enableDrawAllFeatures)
+                    self.db.objTablePrefix = self.objTablePrefix.rstrip('_')          # same database, no need to open (or unzip) it again
                 else:
                     print("No annotations available. Defaulting to original objects...")
             
@@ -229,6 +299,8 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
     def cleanup(self):
         if self.db is not None:
             self.db.close()
+        elif self.dbGZfile is not None:
+            self.dbGZfile.close()               # unzipped but never opened, remove the temp file
     
     def saveObjects(self, key=None):
         """Save all of the objects to new tables (with the given tablePrefix) in the database."""
@@ -279,6 +351,7 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
     def toggleObjectFeaturePlotting(self):
         """Toggle object feature plotting on/off by changing the drawObjectFeatures flag."""
         self.drawObjectFeatures = not self.drawObjectFeatures
+        self.setPlotLeaf()
         ofon = 'on' if self.drawObjectFeatures else 'off'
         print("Object feature plotting {}".format(ofon))
         self.update()
@@ -306,72 +379,96 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
             fp = cvmoving.getFeaturePositionAtInstant(feat, i, invHom=self.invHom)
             p = cvgeom.imagepoint(fp.x, fp.y, color=feat.color)
             self.drawPoint(p, pointIndex=False)
+    
+    def plotFeaturePoints(self, feats, i, color='random'):
+        """
+        Plot the features that exist at instant i as points, like
+        plotFeaturePoint, projecting and drawing them all at once.
+        """
+        feats = [f for f in feats if f.existsAtInstant(i)]
+        if len(feats) > 0:
+            for f in feats:
+                if not hasattr(f, 'color'):
+                    f.color = cvgeom.getColorCode(color)
+            xs, ys = cvmoving.getFeatureArraysAtInstant(feats, i, self.invHom)
+            self.drawPointArray(xs, ys, [f.color for f in feats])
         
     def plotObjectFeatures(self, obj, i):
         """Plot the features that make up the object as points (with no historical trajectory)."""
-        if len(obj.subObjects) > 0:
-            for o in obj.subObjects:
-                self.plotObjectFeatures(o, i)           # recurse into sub objects
-        else:
-            if obj.existsAtInstant(i) and obj.drawAsJoined():
+        for o in obj.getLeaves():
+            if len(o.subObjects) == 0 and o.existsAtInstant(i) and o.drawAsJoined():
                 # if we are supposed to plot this object, get its features and plot them as points (but no historical trajectory)
-                featPositions = obj.getFeaturePositionsAtInstant(i)             # gives us all the joined features as well
-                
-                # plot all the points
-                for fp in featPositions:
-                    p = cvgeom.imagepoint(fp.x, fp.y, color=obj.color)
-                    self.drawPoint(p, pointIndex=False)                     # we would need to change a few things to get ID's, so we'll leave it out until we need it
+                xs, ys = o.getFeatureArraysAtInstant(i)             # gives us all the joined features as well
+                self.drawPointArray(xs, ys, o.color)                # we would need to change a few things to get ID's, so we'll leave it out until we need it
     
     def plotObject(self, obj, endPos):
         """Plot the trajectory of the given object from it's beginning to endPos (i.e. 'now' in the
            video player). Also draws a bounding box if withBoxes is True."""
-        self.db.update()
+        plotLeaf = self.plotLeafFun
+        for o in obj.getLeaves():
+            plotLeaf(o, endPos)
+    
+    def setPlotLeaf(self):
+        """
+        Choose the method plotObject uses for each object based on the
+        settings (which only change when toggled), so they aren't checked
+        for every object in every frame.
+        """
+        self.plotLeafFun = self.plotLeafWithFeatures if self.drawObjectFeatures else self.plotLeaf
+    
+    def plotLeafWithFeatures(self, obj, endPos):
+        """Plot a single object (like plotLeaf) along with its features."""
+        if self.plotLeaf(obj, endPos):
+            self.plotObjectFeatures(obj, endPos)
+    
+    def plotLeaf(self, obj, endPos):
+        """
+        Plot a single object from ImageObject.getLeaves (without its sub
+        objects). Returns True if the object's trajectory was plotted.
+        """
         if obj.isExploded:
-            # plot features and sub objects
-            for f in obj.ungroupedFeatures.values():
-                self.plotFeaturePoint(f, endPos, color=obj.color)
-            if len(obj.subObjects) > 0:
-                # if this object has sub objects, plot those instead (recursing)
-                for o in obj.subObjects:
-                    self.plotObject(o, endPos)
+            # plot the features that are not grouped into sub objects
+            self.plotFeaturePoints(obj.ungroupedFeatures.values(), endPos, color=obj.color)
         else:
             # otherwise plot this object
             if obj.existsAtInstant(endPos):
                 if obj.drawAsJoined() and not obj.hidden:
-                    # get the object trajectory up to this point
-                    traj = obj.toInstant(endPos)
-                    
-                    if obj.color is None:
-                        # pick a random color if we don't already have one
-                        obj.color = cvgeom.randomColor()
+                    # get the object trajectory up to this point as an int array
+                    pts = obj.toInstantArray(endPos)
                     
-                    # plot it on the image as a series of line segments
-                    if len(traj) > 1:
-                        for i in range(1, len(traj)):
-                            a = traj[i-1].asint().astuple()
-                            p = traj[i].asint()
-                            b = p.astuple()
-                            cv2.line(self.img, a, b, obj.color)
-                        
-                        # plot the object position as a point
-                        p = cvgeom.imagepoint(p.x,p.y,color=obj.color)
-                        self.drawPoint(p, pointIndex=False)
-                        
-                        # also the features
-                        if self.drawObjectFeatures:
-                            self.plotObjectFeatures(obj, endPos)
+                    # add it to the trajectories drawn at the end of the frame (see drawTrajLines),
+                    # which also draws the object position (the last point) as a point
+                    if len(pts) > 1:
+                        self.trajLines.append((pts, obj.color))
+                        return True
             #elif obj.getNum() in self.objects and isinstance(self.objects[obj.getNum()], cvgeom.imagebox):
                 ## if this object doesn't exist but is still drawn, remove it from the list
                 #del self.objects[obj.getNum()]
+        return False
     
     def dbUpdate(self):
+        if self.db is None:
+            return                      # still opening
         self.db.update()
-        for mo in self.imgObjects:
-            if mo.obj.num not in self.movingObjects:
-                self.movingObjects[mo.obj.num] = cvgeom.PlaneObjectTrajectory.fromImageObject(mo)
+        # only the objects that arrived since the last update need trajectories
+        newObjects = self.imgObjects[self.nImgObjectsAdded:]
+        if len(newObjects) > 0:
+            for mo in newObjects:
+                if mo.obj.num not in self.movingObjects:
+                    self.movingObjects[mo.obj.num] = cvgeom.PlaneObjectTrajectory.fromImageObject(mo)
+            self.imgFirsts = np.append(self.imgFirsts, [mo.obj.getFirstInstant() for mo in newObjects])
+            self.imgLasts = np.append(self.imgLasts, [mo.obj.getLastInstant() for mo in newObjects])
+            self.imgOrder = np.argsort(self.imgFirsts, kind='stable')
+            self.imgSortedFirsts = self.imgFirsts[self.imgOrder]
+            self.imgMaxLength = int(np.max(self.imgLasts - self.imgFirsts))
+            self.nImgObjectsAdded = len(self.imgObjects)
+        # give the features that arrived since the last update their colors (once, instead of checking every frame)
+        for f in self.features[self.nFeaturesColored:]:
+            f.color = cvgeom.getColorCode('random')
+        self.nFeaturesColored = len(self.features)
     
     def drawExtra(self):
-        # update objects from database reader
+        # update objects from database reader (once per frame, plotObject doesn't)
         self.dbUpdate()
         #self.objects = cvgeom.ObjectCollection()
         #self.points = cvgeom.ObjectCollection()
@@ -382,18 +479,58 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
     
     def drawFeaturePoints(self):
         """Add all features in the current frame to the image."""
-        i = self.getVideoPosFrames()               # get the current frame number
+        i = self.posFrames                         # current frame number (updated by readFrame)
         if i < self.nFrames - 1:
-            for feat in self.features:
-                self.plotFeaturePoint(feat, i)
+            feats = [f for f in self.features if f.existsAtInstant(i)]           # (colors are assigned in dbUpdate)
+            xs, ys = cvmoving.getFeatureArraysAtInstant(feats, i, self.invHom)
+            self.drawPointArray(xs, ys, [f.color for f in feats])
     
     def drawTrajObjects(self):
         """Add annotations to the image, and show it in the player."""
         # go through each object to draw them on the image
-        i = self.getVideoPosFrames()               # get the current frame number
+        i = self.posFrames                         # current frame number (updated by readFrame)
         if i < self.nFrames - 1:
-            for obj in self.imgObjects:
-                self.plotObject(obj, i)
+            self.trajLines = []
+            # only plot the objects that exist in this frame (sub objects and joined objects are drawn within their object's interval)
+            for k in self.getImgObjectIndicesAtInstant(i):
+                self.plotObject(self.imgObjects[k], i)
+            self.drawTrajLines()
+    
+    def getImgObjectIndicesAtInstant(self, i):
+        """
+        Get the indices (in imgObjects, in order) of the objects whose time
+        interval contains instant i, using the arrays built in dbUpdate. Only
+        the objects that start between i - imgMaxLength and i can exist at i,
+        so those are found with a binary search instead of checking them all.
+        """
+        lo = np.searchsorted(self.imgSortedFirsts, i - self.imgMaxLength, side='left')
+        hi = np.searchsorted(self.imgSortedFirsts, i, side='right')
+        candidates = self.imgOrder[lo:hi]
+        return np.sort(candidates[self.imgLasts[candidates] >= i])
+    
+    def drawTrajLines(self):
+        """
+        Draw the trajectories collected by plotObject as polylines, and the
+        current position of each object (the end of its trajectory) as a point.
+        """
+        if len(self.trajLines) == 0:
+            return
+        if njit is not None:
+            # pack all of the trajectories into arrays and draw them at once
+            offsets = np.zeros(len(self.trajLines)+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(pts) for pts, color in self.trajLines])
+            if offsets[-1] > len(self.trajArena):
+                # grow the buffer (doubling) instead of allocating new arrays every frame
+                self.trajArena = np.empty((max(offsets[-1], 2*len(self.trajArena)), 2), dtype=np.int32)
+            for k, (pts, color) in enumerate(self.trajLines):
+                self.trajArena[offsets[k]:offsets[k+1]] = pts
+            colors = np.array([color for pts, color in self.trajLines], dtype=self.img.dtype)
+            drawPolylines(self.img, self.trajArena, offsets, colors)
+        else:
+            for pts, color in self.trajLines:
+                cv2.polylines(self.img, [pts.reshape(-1,1,2).astype(np.int32)], False, color, thickness=1, lineType=cv2.LINE_8)         # cv2 only draws int32 points
+        ends = np.array([pts[-1] for pts, color in self.trajLines], dtype=np.int32)      # not int16, rint would make it float16
+        self.drawPointArray(ends[:,0], ends[:,1], [color for pts, color in self.trajLines])
     
     # ### Methods for joining/exploding objects (using actions so they can be undone/redone) ###
     def finishCreatingObject(self):
@@ -412,30 +549,33 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
             self.isPaused = False
     
     def joinFeaturesInRegion(self, reg):
-        poly = reg.polygon()
-        feats = []
-        # get all the features inside the region
-        for f in self.groupingObject.ungroupedFeatures.values():
-            i = self.getVideoPosFrames()
-            if f.existsAtInstant(i):
-                fp = cvmoving.getFeaturePositionAtInstant(f, i, invHom=self.invHom)
-                if poly.contains(fp.asShapely()):
-                    feats.append(f.num)
+        poly = shapely.prepared.prep(reg.polygon())         # prepared, since it is tested against every feature
+        i = self.posFrames
+        # get all the features inside the region (projecting all the features that exist now at once)
+        existing = [f for f in self.groupingObject.ungroupedFeatures.values() if f.existsAtInstant(i)]
+        xs, ys = cvmoving.getFeatureArraysAtInstant(existing, i, self.invHom)
+        feats = [f.num for f, x, y in zip(existing, xs, ys) if poly.contains(shapely.geometry.Point(x, y))]
         
         # group the features
         a = FeatureGrouper(self.groupingObject, feats, self.hom, self.invHom, self.movingObjects)
         self.do(a)
     
+    def getSelectedImageObjects(self):
+        """
+        Get the selected image objects and their moving objects (as two lists
+        in the same order), in one pass over the selected objects.
+        """
+        sobjs = self.selectedFromObjList('movingObjects')
+        nObjs = len(self.imgObjects)
+        selected = [(self.imgObjects[i], mo) for i, mo in sobjs.items() if i < nObjs]
+        objs = [io for io, mo in selected]
+        mobjs = [mo for io, mo in selected]
+        return objs, mobjs
+    
     def joinSelected(self, key=None):
         """Join the selected objects."""
         # create an ObjectJoiner object with the current list of selected objects
-        sobjs = self.selectedFromObjList('movingObjects')
-        objs = []
-        mobjs = []
-        for i in sobjs.keys():
-            if i < len(self.imgObjects):
-                objs.append(self.imgObjects[i])
-                mobjs.append(sobjs[i])
+        objs, mobjs = self.getSelectedImageObjects()
         #print(self.imgObjects)
         a = ObjectJoiner(objs, mobjs)
         
@@ -443,14 +583,8 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
         self.do(a)
         
         # added clearSelected() to deselect after joining selected boxes
+        # (ObjectJoiner.do hides all but the object that represents the group, so nothing needs filtering)
         self.clearSelected()
-        
-        # update the list of objects to draw to reflect only the object that represents the joined objects
-        #oids = sorted(sobjs.keys())
-        #for oid in oids[1:]:
-            #if oid in self.objects:
-                #del self.objects[oid]
-        #self.selectedObjects = [o for o in self.selectedObjects if o.drawAsJoined(self.getVideoPosFrames())]
     
     def explodeObject(self, key=None):
         """
@@ -478,13 +612,7 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
     def deleteObject(self, key=None):
         """Delete the selected objects."""
         # create an ObjectDeleter object with the current list of selected objects
-        sobjs = self.selectedFromObjList('movingObjects')
-        objs = []
-        mobjs = []
-        for i in sobjs.keys():
-            if i < len(self.imgObjects):
-                objs.append(self.imgObjects[i])
-                mobjs.append(sobjs[i])
+        objs, mobjs = self.getSelectedImageObjects()
         #print(self.imgObjects)
         a = ObjectDeleter(objs, mobjs)
         
@@ -510,7 +638,7 @@ class cvTrajOverlayPlayer(cvgui.cvPlayer):
                 objs = [self.imgObjects[i] for i in sobjs.keys() if i < len(self.imgObjects)]
             else:
                 # no selected objects - take all objects at current instant
-                objs = [o for o in self.imgObjects if o.existsAtInstant(self.posFrames)]
+                objs = [self.imgObjects[k] for k in self.getImgObjectIndicesAtInstant(self.posFrames)]
             
             # loop through objects and assign lanes
             hs = "At frame {}:".format(self.posFrames)
@@ -1,8 +1,11 @@
 import os, sys, subprocess
+import io
 import argparse
 import subprocess
 import threading
+import asyncio
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 from random import random, randint
 import numpy as np
 from configobj import ConfigObj
@@ -10,28 +13,66 @@ from configobj import ConfigObj
 # TODO NOTE - load only the useful configuration
 class CVConfigList(object):
     def __init__(self):
-        self.range = []
+        self.range = np.empty(0, dtype=np.float32)
         self.name = None
         self.next = None
         self.root = None
+        self.total = None
     
+    # NOTE - ranges are stored as float32 (computed in float64 first so the values print cleanly)
     def insert_range (self,initial,end,step):
-        self.range = np.arange(float(initial), float(end) + float(step) / 2, float(step))
+        self.range = np.arange(float(initial), float(end) + float(step) / 2, float(step)).astype(np.float32)
+        self.clear_total()
     
+    # single values are kept as they were written (e.g. so integers don't become floats)
     def insert_value (self,value):
-        self.range.append(value)
+        self.range = np.append(self.range, value)
+        self.clear_total()
     
+    # forget the cached combination counts (they change when a range changes)
+    def clear_total(self):
+        p = self.root if self.root != None else self
+        while p != None:
+            p.total = None
+            p = p.next
+    
+    # number of combinations from this node to the end of the list (cached)
     def get_total_combination(self):
-        if self.name == None:
-            return 1
-        return len(self.range) * self.next.get_total_combination()
+        if self.total is None:
+            if self.name == None:
+                self.total = 1
+            else:
+                self.total = len(self.range) * self.next.get_total_combination()
+        return self.total
     
-    def write_config(self, ID, config):
+    def write_config(self, ID, config, outfile=None):
         if self.name != None:
-            config[self.name] = self.range[(ID/self.next.get_total_combination())];
-            self.next.write_config(ID%self.next.get_total_combination(),config);
+            config[self.name] = self.range[(ID//self.next.get_total_combination())];
+            self.next.write_config(ID%self.next.get_total_combination(),config,outfile);
         else:
-            config.write();
+            config.write(outfile);
+    
+    # number of values of each configuration, i.e. the (mixed) radix of each digit of an ID
+    def get_radices(self):
+        radices = []
+        p = self
+        while p.name != None:
+            radices.append(len(p.range))
+            p = p.next
+        return radices
+    
+    # decode a list of IDs into an array of range indices (one row per ID) all at once
+    def get_indices(self, IDs):
+        return np.array(np.unravel_index(IDs, self.get_radices())).T
+    
+    # same as write_config, but with the range indices from get_indices instead of the ID
+    # (if outfile is given, the config is written there instead of its file)
+    def write_config_indices(self, indices, config, outfile=None):
+        p = self
+        for i in indices:
+            config[p.name] = p.range[i]
+            p = p.next
+        config.write(outfile)
 
     #print the content in the cfg_list.(not used)
     def print_content(self):
@@ -117,9 +158,203 @@ class CVConfigList(object):
     
 # End of methods for genetic algorithm
 # ------------------------------------------------------------------------------
-def wait_all_subproccess(p_list):
-    for p in p_list:
-        p.wait()
+
+# Same as CVConfigList, but stored as parallel lists (names, ranges, lengths)
+# instead of a linked list, so IDs can be decoded with plain index arithmetic.
+class CVConfigTable(object):
+    def __init__(self, names=None, ranges=None):
+        self.names = [] if names is None else list(names)
+        self.ranges = [] if ranges is None else list(ranges)
+        self.lens = [len(r) for r in self.ranges]
+        # suffix[i] is the number of combinations of configurations i to the end (suffix[-1] is 1)
+        self.suffix = [1]
+        for l in reversed(self.lens):
+            self.suffix.insert(0, l * self.suffix[0])
+    
+    # make a table from a (filled) CVConfigList
+    @classmethod
+    def from_list(cls, cfglist):
+        names, ranges = [], []
+        p = cfglist
+        while p.name != None:
+            names.append(p.name)
+            ranges.append(p.range)
+            p = p.next
+        return cls(names, ranges)
+    
+    # NOTE - counts the terminal node like CVConfigList.length
+    def length(self):
+        return len(self.names) + 1
+    
+    def get_total_combination(self):
+        return self.suffix[0]
+    
+    def write_config(self, ID, config, outfile=None):
+        for i, name in enumerate(self.names):
+            config[name] = self.ranges[i][(ID // self.suffix[i+1]) % self.lens[i]]
+        config.write(outfile)
+    
+    def get_radices(self):
+        return list(self.lens)
+    
+    def get_indices(self, IDs):
+        return np.array(np.unravel_index(IDs, self.lens)).T
+    
+    def write_config_indices(self, indices, config, outfile=None):
+        for name, r, i in zip(self.names, self.ranges, indices):
+            config[name] = r[i]
+        config.write(outfile)
+    
+    def print_content(self):
+        for name, r in zip(self.names, self.ranges):
+            print(name, r)
+    
+    # 50% uniform crossover (same as CVConfigList.crossover)
+    def crossover(self, ID1, ID2):
+        for tc in self.suffix[:-1]:
+            if random() > 0.5:
+                newID1 = ID1 - (ID1 % tc) + (ID2 % tc)
+                newID2 = ID2 - (ID2 % tc) + (ID1 % tc)
+                ID1 = newID1
+                ID2 = newID2
+        return ID1, ID2
+    
+    # mutation of a offspringid (same as CVConfigList.mutation)
+    def mutation(self, offspringID, MutationRate):
+        for i, length in enumerate(self.lens):
+            if length > 1:
+                tc = self.suffix[i]
+                mutate_value = self.suffix[i+1]
+                if random() > 0.5:
+                    while random() < MutationRate:
+                        if (offspringID % tc) // mutate_value < length-1:
+                            offspringID += mutate_value
+                else:
+                    while random() < MutationRate:
+                        if (offspringID % tc) // mutate_value > 0:
+                            offspringID -= mutate_value
+        return offspringID
+    
+    def RandomIndividual(self):
+        return randint(0,self.get_total_combination()-1)
+    
+    # decode an array of IDs into genes (one row per ID, one column per configuration)
+    def get_genes(self, IDs):
+        IDs = np.asarray(IDs, dtype=np.int64).reshape(-1)
+        return (IDs[:,None] // np.array(self.suffix[1:], dtype=np.int64)) % np.array(self.lens, dtype=np.int64)
+    
+    # encode genes back into IDs
+    def get_ids(self, genes):
+        return (genes * np.array(self.suffix[1:], dtype=np.int64)).sum(axis=1)
+    
+    # crossover of whole lists of parents at once (parent IDs1[i] with IDs2[i])
+    # NOTE - same distribution as crossover, which ends up swapping each gene with probability 0.5
+    def crossover_all(self, IDs1, IDs2):
+        genes1 = self.get_genes(IDs1)
+        genes2 = self.get_genes(IDs2)
+        swap = np.random.random(genes1.shape) > 0.5
+        return self.get_ids(np.where(swap, genes2, genes1)).tolist(), self.get_ids(np.where(swap, genes1, genes2)).tolist()
+    
+    # mutation of a whole list of offspring IDs at once
+    # NOTE - same distribution as mutation: each gene moves up or down by the number of
+    #        times in a row that random() < MutationRate (geometric), staying in its range
+    def mutation_all(self, IDs, MutationRate):
+        genes = self.get_genes(IDs)
+        steps = np.random.geometric(1 - MutationRate, size=genes.shape) - 1
+        direction = np.where(np.random.random(genes.shape) > 0.5, 1, -1)
+        genes = np.clip(genes + direction * steps, 0, np.array(self.lens, dtype=np.int64) - 1)
+        return self.get_ids(genes).tolist()
+
+# copy the file src to every file in dsts in-kernel (no cp process per copy),
+# using copy_file_range (which can reflink on copy-on-write filesystems) and
+# falling back to sendfile where it is not supported
+def copy_file_to_all(src, dsts):
+    if isinstance(dsts, str):
+        dsts = [dsts]
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        for dst in dsts:
+            with open(dst, 'wb') as fdst:
+                _copy_fd(fsrc.fileno(), fdst.fileno(), size)
+
+def _copy_fd(src_fd, dst_fd, size):
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    # copy_file_range doesn't move the file positions but sendfile writes at the
+    # current position of dst_fd, so continue after whatever was already copied
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+# flush the files in paths to disk, with the fsyncs running in parallel in a
+# pool of threads so their latencies overlap
+def sync_all_files(paths, nThreads=32):
+    def sync_one(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        list(executor.map(sync_one, paths))
+
+# run a command and wait for it, sending data (if any) to its stdin
+def run_subprocess(command, data=None):
+    if data is None:
+        return subprocess.call(command)
+    return subprocess.run(command, input=data).returncode
+
+# run a list of commands with at most nProcess of them running at the same time,
+# sending inputs[i] (if any) to the stdin of commands[i], and return their return codes
+def run_all_subprocess(commands, nProcess=None, inputs=None):
+    if nProcess is None:
+        nProcess = os.cpu_count()
+    if inputs is None:
+        inputs = [None] * len(commands)
+    return asyncio.run(_run_all_subprocess(commands, nProcess, inputs))
+
+async def _run_all_subprocess(commands, nProcess, inputs):
+    semaphore = asyncio.Semaphore(nProcess)
+    async def run_one(command, data):
+        async with semaphore:
+            stdin = asyncio.subprocess.PIPE if data is not None else None
+            p = await asyncio.create_subprocess_exec(*command, stdin=stdin)
+            await p.communicate(data)
+            return p.returncode
+    return await asyncio.gather(*(run_one(c, d) for c, d in zip(commands, inputs)))
+
+# write the cfg with id ID to the file cfg_name, building it in memory first
+# so the file is written with a single write
+def write_config_file(cfglist, ID, cfg_name):
+    buf = io.BytesIO()
+    cfglist.write_config(ID, ConfigObj(), buf)
+    with open(cfg_name, 'wb') as f:
+        f.write(buf.getvalue())
+
+# write one cfg file per row of range indices (from get_indices), using a pool of
+# threads since this is mostly waiting on the disk (each cfg is built in memory
+# and written with a single write)
+def write_all_configs(cfglist, cfg_names, indices, nThreads=None):
+    if nThreads is None:
+        nThreads = min(32, os.cpu_count() * 4)
+    def write_one(cfg_name, idx):
+        buf = io.BytesIO()
+        cfglist.write_config_indices(idx, ConfigObj(), buf)
+        with open(cfg_name, 'wb') as f:
+            f.write(buf.getvalue())
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        list(executor.map(write_one, cfg_names, indices))
 
 # create list of configurations
 def config_to_list(cfglist, config):
@@ -142,3 +377,9 @@ def config_to_list(cfglist, config):
         p.next.root = p.root
         p = p.next
     return 0
+
+# create a CVConfigTable of configurations
+def config_to_table(config):
+    cfglist = CVConfigList()
+    config_to_list(cfglist, config)
+    return CVConfigTable.from_list(cfglist)
@@ -1,74 +1,56 @@
 #!/usr/bin/python
 from random import randint
-from threading import Thread
-from multiprocessing import Process, Queue, Manager
+import heapq, itertools
+from multiprocessing import Pool
 import timeit
 from sys import exit
 """
 Classes and methods for multiprocessing genetic algorithm.
 To use this tool, the target data stucture class should contains 3 methods which are RandomIndividual(), crossover() and mutation().
+If it also has crossover_all() and mutation_all() (which work on lists of individuals), they are used instead to do a whole generation at once.
 The fitness score must be numeric.
 If individual is a class object, the class need to have two additional methods (__hash__ and __eq__).
 """
-# wait for all threads in a thread list
-def join_all_threads(threads):
-    for t in threads:
-        t.join()
-
 # wait for all processes in a process list
 def join_all_processes(processes):
     for p in processes:
         p.join()
 
-# change queue into a list
-def Queue_to_list(queue):
-    # put 'None' at the end of the queue
-    queue.put(None)
-    l = []
-    # iterator stops when meet 'None'
-    for item in iter(queue.get, None):
-        l.append(item)
-    return l
-        
+# fitness function of the pool's worker processes (given once, when each worker starts)
+worker_fitness = None
+
+def init_worker(CalculateFitness):
+    global worker_fitness
+    worker_fitness = CalculateFitness
+
+# calculate a fitness in a worker process (only the individual is sent with each task)
+def worker_evaluate(individual):
+    return worker_fitness(individual)
+
 # Population class that is composed to CVGenetic class
+# individuals are kept in a min-heap of (fitness, order, individual), so the least fit is always at [0]
 class Population(object):
     def __init__(self, size):
         self.size = size
         self.individuals = []
-        self.sorted = False
+        self.order = itertools.count(0, -1)     # decreasing, so earlier individuals win ties
     # add new individual to population
     def add(self, newindividual):
+        entry = (newindividual[1], next(self.order), newindividual)
         if len(self.individuals) < self.size:
-            self.individuals.append(newindividual)
-            self.sorted = False
-        else:
-            least = self.get_least_index()
-            if self.individuals[self.size-1][1] < newindividual[1]:
-                self.individuals[self.size-1] = newindividual
-            self.sorted = False
-    
-    # Get the index of individual with least fitness
-    def get_least_index(self):
-        if not self.sorted:
-            self.sort()
-        return len(self.individuals) - 1
+            heapq.heappush(self.individuals, entry)
+        elif self.individuals[0][0] < newindividual[1]:
+            # replace the individual with least fitness
+            heapq.heapreplace(self.individuals, entry)
     
     # Get N best fitness individual from population
     def get_best(self, N):
-        if not self.sorted:
-            self.sort()
-        return self.individuals[:N]
-    
-    # sort individuals according to thier fitness
-    def sort(self):
-        if not self.sorted:
-            self.individuals.sort(key = lambda t: t[1], reverse = True)
-            self.sorted = True
+        return [entry[2] for entry in heapq.nlargest(N, self.individuals)]
             
     # Check existance of individual (Not used)
     def existed(self, i):
-        for individual in self.individuals:
-            if individual[0] == i:
+        for entry in self.individuals:
+            if entry[2][0] == i:
                 return True
         return False
 
@@ -76,6 +58,9 @@ class Population(object):
 class CVGenetic(object):
     def __init__(self, population_size, DataList, CalculateFitness, accuracy = 5, MutationRate = 0.2, output = True, CrossOverDimension = None):
         print("Initializing Genetic Calculator")
+        # a mutation keeps stepping with probability MutationRate, so it must be less than 1
+        if not 0 <= MutationRate < 1:
+            raise ValueError("MutationRate must be at least 0 and less than 1 (got {})".format(MutationRate))
         # Config
         if CrossOverDimension is None:
             self.CrossOverDimension = (0, DataList.length())
@@ -85,21 +70,14 @@ class CVGenetic(object):
         self.population = Population(population_size)
         self.DataList = DataList
         self.accuracy = accuracy
-        self.best = float("-inf")
+        self.best = None                        # best individual (not its fitness), compared in select
         self.CalculateFitness = CalculateFitness
         self.output = output
         # Config End
-        manager = Manager()
-        self.store = manager.dict()
-        newindividuals = Queue()
-        processes = []
+        self.store = {}
+        self.pool = None
         # initilize population with random individual
-        for i in range(population_size):
-            p = Process(target = self.create_newindividual, args = (DataList.RandomIndividual(), newindividuals))
-            p.start()
-            processes.append(p)
-        join_all_processes(processes)
-        newindividuals = Queue_to_list(newindividuals)
+        newindividuals = self.evaluate([DataList.RandomIndividual() for i in range(population_size)])
         for individual in newindividuals:
             self.population.add(individual)
         self.timer = 0
@@ -125,40 +103,40 @@ class CVGenetic(object):
         # return self.DataList.crossover(parent1, parent2, randint(Dimension[0], Dimension[1]))
         return self.DataList.crossover(parent1, parent2)
     
-    def crossover_t(self, parent1, parent2, offsprings):
-        offspring1, offspring2 = self.crossover(parent1, parent2)
-        offsprings.append(offspring1)
-        offsprings.append(offspring2)
-        
     def mutation(self, offspring):
         return self.DataList.mutation(offspring, self.MutationRate)
     
-    def mutation_t(self, offspring, results):
-        results.append(self.mutation(offspring))
+    # calculate the fitness of the individuals in parallel with a pool of processes
+    # duplicates and individuals that were already calculated are skipped
+    # returns a list of (individual, fitness) for the new individuals
+    def evaluate(self, individuals):
+        newindividuals = []
+        seen = set()
+        for individual in individuals:
+            if individual not in self.store and individual not in seen:
+                seen.add(individual)
+                newindividuals.append(individual)
+        if len(newindividuals) == 0:
+            return []
+        if self.pool is None:
+            self.pool = Pool(initializer = init_worker, initargs = (self.CalculateFitness,))
+        fitnesses = self.pool.map(worker_evaluate, newindividuals)
+        for individual, fitness in zip(newindividuals, fitnesses):
+            self.store[individual] = fitness
+        return list(zip(newindividuals, fitnesses))
     
-    def create_newindividual(self, offspring, newindividuals):
-        fitness = self.get_fitness(offspring)
-        newindividual = (offspring, fitness)
-        newindividuals.put(newindividual)
-
-    # calculate the fitness of the individual
-    # when there is a duplicated processes maintain one and kill the rest
-    def get_fitness(self, individual):
-        try:
-            if (self.store[individual]):
-                exit(0)
-        except KeyError:
-            try:
-                self.store[individual] = self.CalculateFitness(individual)
-                return self.store[individual]
-            except KeyError:
-                exit(0)
+    # stop the pool's processes (a new pool is started if evaluate is called again)
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
                     
     # NOTE - this is slow, run_thread() is recommanded
     def run(self, N = 2):
         if N < 2:
             print("number_parents(N) must be greater or equal to 2")
-            sys.exit(1)
+            exit(1)
         self.timer = 0
         generation = 0
         while True:
@@ -167,33 +145,31 @@ class CVGenetic(object):
             # selection
             bests = self.select(N)
             offsprings = []
-            newindividuals = []
             for i in range(len(bests)):
                 for j in range(i+1, len(bests)):
                     offspring1, offspring2 = self.crossover(bests[i][0], bests[j][0])
                     offsprings.append(offspring1)
                     offsprings.append(offspring2)
-            for offspring in offsprings:
-                offspring = self.mutation(offspring)
-                fitness = self.get_fitness(offspring)
-                newindividual = (offspring, fitness)
-                newindividuals.append(newindividual)
-            best_new = newindividuals[0]
+            newindividuals = self.evaluate([self.mutation(offspring) for offspring in offsprings])
             if self.output:
                 print(newindividuals)
-            for individual in newindividuals:
-                if individual[1] > best_new[1]:
-                    best_new = individual
-            self.population.add(best_new)
-            if self.timer == self.accuracy:
+            if len(newindividuals) > 0:
+                best_new = newindividuals[0]
+                for individual in newindividuals:
+                    if individual[1] > best_new[1]:
+                        best_new = individual
+                self.population.add(best_new)
+            if self.timer >= self.accuracy:
                 break
             generation += 1
+        self.close_pool()
+        return self.best
 
-    # run it and the best ID will be store in self.best
+    # run it and the best ID will be store in self.best (and returned)
     def run_thread(self, N = 3):
         if N < 2:
             print("number_parents(N) must be greater or equal to 2")
-            sys.exit(1)
+            exit(1)
         if N > self.population.size:
             print("number_parents(N) can't be greater than population")
         self.timer = 0
@@ -204,46 +180,30 @@ class CVGenetic(object):
             start = timeit.default_timer()
             # selection
             bests = self.select(N)
-            # crossover
-            offsprings = []
-            threads = []
-            for i in range(len(bests)):
-                for j in range(i+1, len(bests)):
-                    t = Thread(target = self.crossover_t, args = (bests[i][0], bests[j][0], offsprings))
-                    t.start()
-                    threads.append(t)
-            join_all_threads(threads)
-            # mutation
-            mutated_offsprings = []
-            threads = []
-            for offspring in offsprings:
-                t = Thread(target = self.mutation_t, args = (offspring, mutated_offsprings))
-                t.start()
-                threads.append(t)
-            join_all_threads(threads)
+            pairs = list(itertools.combinations([b[0] for b in bests], 2))
+            if hasattr(self.DataList, 'crossover_all') and hasattr(self.DataList, 'mutation_all'):
+                # crossover and mutation of the whole generation at once
+                offsprings1, offsprings2 = self.DataList.crossover_all([p[0] for p in pairs], [p[1] for p in pairs])
+                mutated_offsprings = self.DataList.mutation_all(offsprings1 + offsprings2, self.MutationRate)
+            else:
+                # crossover and mutation one at a time (they hold the GIL, so a thread for each only adds overhead)
+                offsprings = []
+                for parent1, parent2 in pairs:
+                    offsprings.extend(self.crossover(parent1, parent2))
+                mutated_offsprings = [self.mutation(offspring) for offspring in offsprings]
             # create new individual
-            newindividuals = Queue()
-            processes = []
-            for mutated in mutated_offsprings:
-                p = Process(target = self.create_newindividual, args = (mutated, newindividuals))
-                p.start()
-                processes.append(p)
-            join_all_processes(processes)
-            newindividuals = Queue_to_list(newindividuals)
+            newindividuals = self.evaluate(mutated_offsprings)
             if self.output:
                 print(newindividuals)
             # add the best to population
-            # print(newindividuals)
-            if len(newindividuals) is not 0:
-                for individual in newindividuals:
-                    self.population.add(individual)
-                    # if individual[1] > best_new[1]:
-                    #     best_new = individual
-                # self.population.add(best_new)
-            if self.timer == self.accuracy:
+            for individual in newindividuals:
+                self.population.add(individual)
+            if self.timer >= self.accuracy:
                 break
             generation += 1
             stop = timeit.default_timer()
             if self.output:
                 print(str(stop-start)+"s")
+        self.close_pool()
+        return self.best
             
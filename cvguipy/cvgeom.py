@@ -258,9 +258,12 @@ class PlaneObjectTrajectory(PlaneObject):
             o.select()
     
     def deselect(self):
-        self.selected = False
-        for o in self.objects:
-            o.deselect()
+        # the objects are only selected along with the trajectory, so there
+        # is nothing to do if it is not selected (avoids touching every instant)
+        if self.selected:
+            self.selected = False
+            for o in self.objects:
+                o.deselect()
     
     def setiNow(self, i):
         """Set the value for iNow (the current point in time)."""
@@ -331,6 +334,7 @@ class imagepoint(PlaneObject):
         
         # linear distance of this point along a line to which it belongs (if applicable)
         self.linearDistance = None
+        self.shapelyKey = None                  # coordinates the shapely object was made from
     
     @classmethod
     def fromPoint(cls, p, **kwargs):
@@ -369,7 +373,10 @@ class imagepoint(PlaneObject):
     
     def genShapelyObj(self):
         if self.x is not None and self.y is not None:
-            self.shapelyObj = shapely.geometry.Point(self.x, self.y)
+            # only remake the point if it moved (a click point is compared to many objects)
+            if self.shapelyObj is None or (self.x, self.y) != self.shapelyKey:
+                self.shapelyObj = shapely.geometry.Point(self.x, self.y)
+                self.shapelyKey = (self.x, self.y)
     
     def pushBack(self):
         self.index += 1
@@ -405,6 +412,7 @@ class MultiPointObject(PlaneObject):
         super(MultiPointObject, self).__init__(**kwargs)
         
         self.points = ObjectCollection() if points is None else points
+        self.shapelyKey = None                  # points the shapely object was made from
         
         # set the color on any points we have
         for p in self.points.values():
@@ -479,7 +487,11 @@ class MultiPointObject(PlaneObject):
     def genShapelyObj(self):
         """Make a shapely MultiPoint object."""
         if len(self.points) > 0:
-            self.shapelyObj = shapely.geometry.MultiPoint(self.asTuple())
+            # points are moved in place, so compare against the points the object was made from
+            pts = self.asTuple()
+            if self.shapelyObj is None or pts != self.shapelyKey:
+                self.shapelyObj = shapely.geometry.MultiPoint(pts)
+                self.shapelyKey = pts
     
     def select(self):
         self.selected = True
@@ -500,20 +512,20 @@ class MultiPointObject(PlaneObject):
         cp = imagepoint(x, y)
         indx = None
         if len(self.points) >= 2:             # we need at least two points to insert it
-            # loop over point pairs
+            # loop over point pairs (each point is the end of one pair and the start of the next)
             indeces = sorted(self.points.keys())
-            p1, p2 = None, None
-            for i in range(0, len(indeces)-1):
-                p1 = self.points[indeces[i]]
-                p2 = self.points[indeces[i+1]]
+            cps = cp.asShapely()
+            p2 = self.points[indeces[0]]
+            for i2 in indeces[1:]:
+                p1, p2 = p2, self.points[i2]
                 line = shapely.geometry.LineString([p1.asTuple(), p2.asTuple()])
-                if line.distance(cp.asShapely()) < clickRadius:
-                    indx = indeces[i+1]
+                if line.distance(cps) < clickRadius:
+                    indx = i2
                     break
             if indx is None and isinstance(self, imageregion):
                 # if we make it here, check p2 (the last point) to self.points[indeces[0]] (the first point)
                 line = shapely.geometry.LineString([p2.asTuple(), self.points[indeces[0]].asTuple()])
-                if line.distance(cp.asShapely()) < clickRadius:
+                if line.distance(cps) < clickRadius:
                     indx = self.getNextIndex()          # if it matches, insert at the end
         return indx
     
@@ -768,7 +780,10 @@ class imageline(MultiPointObject):
             return shapely.geometry.LineString(self.asTuple())
         
     def genShapelyObj(self):
-        self.shapelyObj = self.linestring()
+        pts = self.asTuple()
+        if self.shapelyObj is None or pts != self.shapelyKey:
+            self.shapelyObj = self.linestring()
+            self.shapelyKey = pts
     
     def sortPointsBySide(self, points):
         """
@@ -864,6 +879,8 @@ class imagebox(MultiPointObject):
         
         self.shapelyPolygon = None
         self.minX, self.minY, self.maxX, self.maxY = None, None, None, None
+        self.shapelyKey = None                  # corners the shapely object was made from
+        self.drawKey, self.drawPoints = None, (None, None)         # corners the points for drawing were made from, and the points
         if pMin is not None:
             self.minX, self.minY = pMin.x, pMin.y
         if pMax is not None:
@@ -878,7 +895,11 @@ class imagebox(MultiPointObject):
         
     def genShapelyObj(self):
         if all([self.minX, self.minY, self.maxX, self.maxY]):
-            self.shapelyObj = shapely.geometry.box(self.minX, self.minY, self.maxX, self.maxY)
+            # the box is redrawn and clicked on many times without moving, so only remake it if it moved
+            key = (self.minX, self.minY, self.maxX, self.maxY)
+            if self.shapelyObj is None or key != self.shapelyKey:
+                self.shapelyObj = shapely.geometry.box(self.minX, self.minY, self.maxX, self.maxY)
+                self.shapelyKey = key
     
     def polygon(self):
         if len(self.points) >= 3:
@@ -909,11 +930,14 @@ class imagebox(MultiPointObject):
         self.shapelyPolygon = self.polygon()
     
     def pointsForDrawing(self):
-        pMin, pMax = None, None
-        if all([self.minX, self.minY, self.maxX, self.maxY]):
-            pMin = imagepoint(self.minX, self.minY)
-            pMax = imagepoint(self.maxX, self.maxY)
-        return pMin, pMax
+        key = (self.minX, self.minY, self.maxX, self.maxY)
+        if key != self.drawKey:
+            pMin, pMax = None, None
+            if all([self.minX, self.minY, self.maxX, self.maxY]):
+                pMin = imagepoint(self.minX, self.minY)
+                pMax = imagepoint(self.maxX, self.maxY)
+            self.drawKey, self.drawPoints = key, (pMin, pMax)
+        return self.drawPoints
     
     def getImagePoints(self):
         self.points = ObjectCollection()
@@ -943,7 +967,10 @@ class imageregion(MultiPointObject):
             return shapely.geometry.LinearRing(self.asTuple())
     
     def genShapelyObj(self):
-        self.shapelyObj = self.boundary()
+        pts = self.asTuple()
+        if self.shapelyObj is None or pts != self.shapelyKey:
+            self.shapelyObj = self.boundary()
+            self.shapelyKey = pts
     
     def polygon(self):
         if len(self.points) >= 3:
@@ -958,15 +985,22 @@ class ObjectCollection(dict):
         """Return an ObjectCollection containing only the objects that are selected."""
         return ObjectCollection({i: o for i, o in self.items() if o.selected})
     
-    def getClosestObject(self, o):
-        """Returns the key of the object that is closest to the object o."""
+    def getClosestObject(self, o, keys=None, withDistance=False):
+        """
+        Returns the key of the object that is closest to the object o. If keys
+        is given, only the objects with those keys are considered. If
+        withDistance is True, returns (key, distance) instead.
+        """
         minDist = np.inf
         minI = None
-        for i, p in self.items():
+        items = self.items() if keys is None else ((i, self[i]) for i in keys if i in self)
+        for i, p in items:
             d = p.distance(o)
             if d is not None and d < minDist:
                 minDist = d
                 minI = i
+        if withDistance:
+            return minI, minDist
         return minI
     
     def sortByDistance(self, obj, reverse=False):
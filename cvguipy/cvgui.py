@@ -27,7 +27,8 @@ if cv2.__version__[0] == '2':
     
     # original waitKey function fine in opencv 2
     cvWaitKey = cv2.waitKey
-elif cv2.__version__[0] == '3':
+else:
+    # opencv 3 and later
     cvFONT_HERSHEY_PLAIN = cv2.FONT_HERSHEY_PLAIN
     cvCAP_PROP_FRAME_WIDTH = cv2.CAP_PROP_FRAME_WIDTH
     cvCAP_PROP_FRAME_HEIGHT = cv2.CAP_PROP_FRAME_HEIGHT
@@ -563,6 +564,7 @@ class cvGUI(object):
         self.timestamp = None
         self.isRealtime = False
         self.mask = None
+        self.textSizes = {}                 # {text: (width, height)} of object names drawn with cv2.putText
         self.videoFourCC = cvFOURCC('X','V','I','D')      # NOTE - don't try to use H264, it's often broken
         
         # mouse and keyboard functions are registered by defining a function in this class (or one based on it) and inserting it's name into the mouseBindings or keyBindings dictionaries
@@ -1462,11 +1464,10 @@ class cvGUI(object):
         for objListName in self.selectableObjects:
             # get the object closest to our click point
             objList = getattr(self, objListName)
-            i = objList.getClosestObject(cp)
+            i, d = objList.getClosestObject(cp, keys=self.getClickCandidates(objListName, x, y), withDistance=True)
             if i is not None:
                 o = objList[i]
-                d = o.distance(cp)
-                if d is not None and d <= self.clickRadius:
+                if d <= self.clickRadius:
                     # if it is within clickRadius
                     if isinstance(o, cvgeom.MultiPointObject):
                         # if it's a MultiPointObject, check if we clicked on one of its points
@@ -1476,6 +1477,13 @@ class cvGUI(object):
                     # otherwise just return the object
                     return o
     
+    def getClickCandidates(self, objListName, x, y):
+        """
+        Return the keys of the objects in the list objListName that could be
+        within clickRadius of (x,y), or None to check all of them (the default).
+        """
+        return None
+    
     def userCheckXY(self, x, y):
         """
         User-implementable function to check points clicked by the user without
@@ -1512,7 +1520,7 @@ class cvGUI(object):
         """Clear all selected points and regions."""
         for objListName in self.selectableObjects:
             objList = getattr(self, objListName)
-            for o in objList.values():
+            for o in objList.selectedObjects().values():
                 o.deselect()
         self.update()
         
@@ -1853,6 +1861,28 @@ class cvGUI(object):
             if pointIndex:
                 self.drawText(p.getIndex(), p.x, p.y, self.textFontSize, color=p.color, thickness=2)
         
+    def drawPointArray(self, xs, ys, colors):
+        """
+        Draw many points (not selected and without indexes) as circles with
+        crosshairs, like drawPoint, from arrays of their x and y coordinates
+        without making an imagepoint for each. colors is one color for all
+        the points or a list with a color for each point.
+        """
+        if self.showCoordinates:
+            # let drawPoint handle the coordinate text
+            for k, (x, y) in enumerate(zip(xs, ys)):
+                c = colors[k] if isinstance(colors, list) else colors
+                self.drawPoint(cvgeom.imagepoint(x, y, color=c), pointIndex=False)
+            return
+        r = self.clickRadius
+        xs = np.rint(xs).astype(int).tolist()
+        ys = np.rint(ys).astype(int).tolist()
+        for k, (x, y) in enumerate(zip(xs, ys)):
+            c = colors[k] if isinstance(colors, list) else colors
+            cv2.circle(self.img, (x, y), r, c, thickness=self.lineThickness)
+            cv2.line(self.img, (x - r, y), (x + r, y), c, thickness=1)
+            cv2.line(self.img, (x, y - r), (x, y + r), c, thickness=1)
+    
     def drawBox(self, box, boxIndex=True):
         """Draw a cvgeom.imagebox instance on the image as a rectangle, and with a thicker
            line and points at the corners if it is selected."""
@@ -1860,7 +1890,7 @@ class cvGUI(object):
         lt = 4*dlt if box.selected else dlt
         pMin, pMax = box.pointsForDrawing()
         if pMin is not None and pMax is not None:
-            cv2.rectangle(self.img, (pMin.x, pMin.y), (pMax.x, pMax.y), box.color, thickness=lt)
+            cv2.rectangle(self.img, (pMin.x, pMin.y), (pMax.x, pMax.y), box.color, thickness=lt, lineType=cv2.LINE_8)
             if boxIndex and self.showObjectText:
                 self.drawText(box.getIndex(), pMax.x, pMin.y, self.textFontSize, color=box.color, thickness=2)
         
@@ -1908,9 +1938,12 @@ class cvGUI(object):
                     # get the text origin
                     p = obj.points[obj.points.getFirstIndex()]
                     tx, ty = p.asTuple()
+                    nameStr = obj.getNameStr()
                     
-                    # check if the text will go offscreen
-                    textWidth, textHeight = cv2.getTextSize(obj.getNameStr(), cvFONT_HERSHEY_PLAIN, 4.0, 2)[0]
+                    # check if the text will go offscreen (sizes are cached since the same names are drawn every frame)
+                    if nameStr not in self.textSizes:
+                        self.textSizes[nameStr] = cv2.getTextSize(nameStr, cvFONT_HERSHEY_PLAIN, 4.0, 2)[0]
+                    textWidth, textHeight = self.textSizes[nameStr]
                     textRightX = p.x + textWidth
                     textTopY = p.y - textHeight      # +Y down
                     
@@ -1923,7 +1956,7 @@ class cvGUI(object):
                     
                     #import pdb; pdb.set_trace()
                     
-                    cv2.putText(self.img, obj.getNameStr(), (tx, ty), cvFONT_HERSHEY_PLAIN, 4.0, obj.color, thickness=2, bottomLeftOrigin=bottomLeft)
+                    cv2.putText(self.img, nameStr, (tx, ty), cvFONT_HERSHEY_PLAIN, 4.0, obj.color, thickness=2, bottomLeftOrigin=bottomLeft)
     
     def drawFrameObjects(self):
         """
@@ -2062,6 +2095,8 @@ class cvPlayer(cvGUI):
         self.frameTrackbar = None
         self.movingObjects = cvgeom.ObjectCollection()
         self.addToSelectPool('movingObjects', self.movingObjects)
+        self.movingObjectGrid = None                            # grid cell -> keys of the moving objects drawn in that cell (for clicks)
+        self.gridCellSize = 32
         
         # key/mouse bindings
         # self.keyBindings[<code>] = 'fun'                  # method 'fun' must take key code as only required argument
@@ -2189,13 +2224,37 @@ class cvPlayer(cvGUI):
         self.showFrame()
     
     def drawMovingObjects(self):
-        for mo in self.movingObjects.values():
+        grid = {}
+        posFrames = self.posFrames
+        for i, mo in self.movingObjects.items():
             if isinstance(mo, cvgeom.PlaneObjectTrajectory):
-                mo.setiNow(self.posFrames)
+                mo.setiNow(posFrames)
                 if not mo.hidden:
-                    o = mo.getObjectAtInstant(self.posFrames)
+                    o = mo.getObjectAtInstant(posFrames)
                     if o is not None:
-                        self.drawObject(o)
+                        # trajectory boxes go straight to drawBox (one cv2.rectangle each)
+                        if isinstance(o, cvgeom.imagebox) and not o.hidden:
+                            self.drawBox(o)
+                        else:
+                            self.drawObject(o)
+                        self.addToGrid(grid, i, o)
+        self.movingObjectGrid = grid
+    
+    def addToGrid(self, grid, i, o):
+        """
+        Add key i to every cell of the grid that box o (grown by clickRadius)
+        touches, so clicks only need to check the objects in one cell.
+        """
+        if isinstance(o, cvgeom.imagebox) and all([o.minX, o.minY, o.maxX, o.maxY]):
+            r, cs = self.clickRadius, self.gridCellSize
+            for cx in range(int(o.minX - r)//cs, int(o.maxX + r)//cs + 1):
+                for cy in range(int(o.minY - r)//cs, int(o.maxY + r)//cs + 1):
+                    grid.setdefault((cx, cy), []).append(i)
+    
+    def getClickCandidates(self, objListName, x, y):
+        """Use the grid built when drawing the moving objects to limit the objects checked."""
+        if objListName == 'movingObjects' and self.movingObjectGrid is not None:
+            return self.movingObjectGrid.get((x//self.gridCellSize, y//self.gridCellSize), [])
     
     def drawFrame(self):
         """Apply the mask and draw points, selectedPoints, and the selectBox on the frame."""
@@ -2247,12 +2306,13 @@ class cvPlayer(cvGUI):
         """
         selectedObjects = super(cvPlayer, self).selectedFromObjList(objListName)
         goodObjects = {}
+        posFrames = self.posFrames
         
         for i, o in selectedObjects.items():
             if isinstance(o, cvgeom.PlaneObjectTrajectory):
                 # if PlaneObjectTrajectory, only add if it exists now
                 # also don't let hidden objects through
-                if o.existsAtInstant(self.posFrames) and not o.hidden:
+                if not o.hidden and o.existsAtInstant(posFrames):
                     goodObjects[i] = o
                 else:
                     # if it doesn't exist, deselect it
@@ -2,12 +2,25 @@
 """Classes for working with homographies easily."""
 
 import os, sys, time, argparse, traceback
-import ast
+import ast, functools
 import numpy as np
 import multiprocessing, queue
 import cv2
 from . import cvgeom
 
+@functools.lru_cache(maxsize=None)
+def loadHomography(filename):
+    """
+    Load a homography from a text file, returning it and its inverse (not
+    normalized, like np.linalg.inv). Results are cached per file, so the
+    arrays are read-only.
+    """
+    hom = np.loadtxt(filename, dtype=np.float64)
+    invHom = np.linalg.solve(hom, np.eye(3))
+    hom.flags.writeable = False
+    invHom.flags.writeable = False
+    return hom, invHom
+
 class Homography(object):
     """
     A class containing a homography computed from a set of point
@@ -180,12 +193,14 @@ class Homography(object):
         if self.homography is not None:
             np.savetxt(filename, self.homography)
     
-    def projectPointArray(self, points, invert=False):
+    def projectPointArray(self, points, invert=False, hom=None):
         """
         Project the N x 2 matrix of points using our homography. This involves converting
         the points from Cartesian coordinates to homogeneous coordinates, which makes
         translations linearly independent, allowing us to consider the transformation as
         an affine transformation and compute the projection using matrix multiplication.
+        A different 3x3 matrix (e.g. the homography combined with a scale) can be
+        used by passing it as hom.
         """
         nPoints = points.shape[0]
         if nPoints > 0:
@@ -194,7 +209,8 @@ class Homography(object):
             homogeneousCoords = np.append(points.T,[[1]*points.T.shape[1]], 0)
             
             # invert the homography if we are projecting from world space to image space
-            hom = self.inverted if invert else self.homography
+            if hom is None:
+                hom = self.inverted if invert else self.homography
             
             # perform perspective transformation (affine, so we can ignore the w component we set to 1)
             # matrix multiplication of homography x homogeneousCoords
@@ -231,10 +247,17 @@ class Homography(object):
         if self.homography is not None:
             self.inverted = self.invertHomography(self.homography)
     
+    @classmethod
+    def getScaleMatrix(cls, s):
+        """Get the 3x3 matrix that scales homogeneous coordinates by s."""
+        return np.diag([s, s, 1.0])
+    
     def projectToAerial(self, points, objCol=True):
         """Project points from image space to the aerial image (without units) for plotting."""
         if self.homography is not None:
-            pts = self.projectPointArray(self.getPointArray(points))/self.unitsPerPixel
+            # fold the scaling to aerial pixels into the homography so the points are only multiplied once
+            hom = np.dot(self.getScaleMatrix(1.0/self.unitsPerPixel), self.homography)
+            pts = self.projectPointArray(self.getPointArray(points), hom=hom)
             pts = self.getObjColFromArray(pts, indPoints=points) if objCol else pts
             return pts
     
@@ -249,9 +272,9 @@ class Homography(object):
     def projectToImage(self, points, fromAerial=True, objCol=True):
         """Project an ObjectCollection of points from aerial or world space to image space."""
         if self.homography is not None:
-            pArray = self.getPointArray(points)
-            ipts = pArray*self.unitsPerPixel if fromAerial else pArray
-            pts = self.projectPointArray(ipts, invert=True)
+            # fold the scaling from aerial pixels into the inverse homography
+            hom = np.dot(self.inverted, self.getScaleMatrix(self.unitsPerPixel)) if fromAerial else self.inverted
+            pts = self.projectPointArray(self.getPointArray(points), hom=hom)
             pts = self.getObjColFromArray(pts, indPoints=points) if objCol else pts
             return pts
     
@@ -1,18 +1,39 @@
 #!/usr/bin/python
 
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 
 # TrafficIntelligence modules
 from trafficintelligence import moving, cvutils
 
 from . import cvgui, cvgeom
 
+# numba is optional, if available it is used to compute the distances in computeClearMOT
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 def getFeaturePositionAtInstant(f, i, invHom=None):
     """Get the position of a feature in image space at instant i."""
     if not hasattr(f, 'imgPos') and invHom is not None:
         f.imgPos = Trajectory(f.positions.homographyProject(invHom).positions)
     return f.imgPos[i-f.getFirstInstant()]
 
+def getFeatureArraysAtInstant(features, i, invHom):
+    """
+    Get the image space positions of the features at instant i as arrays of
+    x and y coordinates, projecting the features without an imgPos all at
+    once first (see getFeaturePositionAtInstant).
+    """
+    missing = [f for f in features if not hasattr(f, 'imgPos')]
+    if len(missing) > 0:
+        for f, imgPos in zip(missing, projectTrajectories([f.positions for f in missing], invHom)):
+            f.imgPos = imgPos
+    xs = np.array([f.imgPos.positions[0][i-f.getFirstInstant()] for f in features], dtype=np.float64)
+    ys = np.array([f.imgPos.positions[1][i-f.getFirstInstant()] for f in features], dtype=np.float64)
+    return xs, ys
+
 def getCardinalDirection(theta, cardinalDirections=None):
     if cardinalDirections is None:
         cardinalDirections = ['E','NE','N','NW','W','SW','S','SE']
@@ -45,6 +66,149 @@ def getBoxCorners(points):
         pMax = Point(maxX, maxY)
     return pMin, pMax
 
+def projectTrajectories(trajectories, homography):
+    """
+    Project a list of trajectories with the homography all at once, by
+    stacking all of their points in one array (instead of calling
+    homographyProject on each one). Returns a list of Trajectory objects.
+    """
+    lengths = [len(t.positions[0]) for t in trajectories]
+    pts = np.ones((3, sum(lengths)))
+    if pts.shape[1] > 0:
+        pts[0] = np.concatenate([t.positions[0] for t in trajectories])
+        pts[1] = np.concatenate([t.positions[1] for t in trajectories])
+    prod = np.dot(homography, pts)
+    xy = prod[0:2]/prod[2]
+    return [Trajectory(seg.tolist()) for seg in np.split(xy, np.cumsum(lengths)[:-1], axis=1)]
+
+def projectObjects(objects, invHom):
+    """
+    Project the positions of the objects (and their features) into image
+    space in one batch, setting positions.imagespace (and imgPos on the
+    features) like ImageObject.project.
+    """
+    trajs = []
+    for o in objects:
+        trajs.append(o.positions)
+        if o.features is not None:
+            trajs.extend(f.positions for f in o.features)
+    imgTrajs = iter(projectTrajectories(trajs, invHom))
+    for o in objects:
+        o.positions.imagespace = next(imgTrajs)
+        if o.features is not None:
+            for f in o.features:
+                f.imgPos = next(imgTrajs)
+                f.positions.imagespace = f.imgPos
+
+def getWindowPositions(objects, indices, first, last):
+    """
+    Get the positions of objects[indices] at each instant from first to last
+    as an array of shape (last-first+1, len(indices), 2), with NaN where an
+    object does not exist.
+    """
+    xy = np.full((last-first+1, len(indices), 2), np.nan, dtype=np.float64)
+    for k, i in enumerate(indices):
+        o = objects[i]
+        f0, f1 = max(o.getFirstInstant(), first), min(o.getLastInstant(), last)
+        s = f0 - o.getFirstInstant()
+        xy[f0-first:f1-first+1,k,0] = o.getXCoordinates()[s:s+f1-f0+1]
+        xy[f0-first:f1-first+1,k,1] = o.getYCoordinates()[s:s+f1-f0+1]
+    return xy
+
+if njit is not None:
+    @njit(parallel=True, cache=True, nogil=True)
+    def getWindowDistances(gxy, txy):
+        """
+        Distance between every annotation and object at each instant of a
+        window (NaN where either does not exist), see getWindowPositions.
+        """
+        nf, ng, nt = gxy.shape[0], gxy.shape[1], txy.shape[1]
+        D = np.empty((nf, ng, nt), dtype=np.float64)
+        for f in prange(nf):
+            for i in range(ng):
+                for j in range(nt):
+                    dx = gxy[f,i,0] - txy[f,j,0]
+                    dy = gxy[f,i,1] - txy[f,j,1]
+                    D[f,i,j] = np.sqrt(dx*dx + dy*dy)
+        return D
+else:
+    def getWindowDistances(gxy, txy):
+        """
+        Distance between every annotation and object at each instant of a
+        window (NaN where either does not exist), see getWindowPositions.
+        """
+        return np.sqrt(((gxy[:,:,None,:] - txy[:,None,:,:])**2).sum(axis=-1))
+
+def computeClearMOT(annotations, objects, matchingDistance, firstInstant, lastInstant, window=256):
+    """
+    Compute the CLEAR MOT metrics like moving.computeClearMOT, but working on
+    windows of frames: the positions of the annotations and objects that exist
+    in each window are put in arrays and all the distances in the window are
+    computed at once, instead of calling matches for every pair in every frame.
+    The distances are computed in double precision like moving.computeClearMOT
+    so the same pairs are within matchingDistance (see checkClearMOT.py).
+    
+    Output: returns motp, mota, mt, mme, fpt, gt (see moving.computeClearMOT)
+    """
+    gtFirst = np.array([a.getFirstInstant() for a in annotations])
+    gtLast = np.array([a.getLastInstant() for a in annotations])
+    toFirst = np.array([o.getFirstInstant() for o in objects])
+    toLast = np.array([o.getLastInstant() for o in objects])
+    dist, ct, mt, mme, fpt, gt = 0., 0, 0, 0, 0, 0
+    matches = {}                # annotation index -> object index
+    for w0 in range(firstInstant, lastInstant+1, window):
+        w1 = min(w0+window-1, lastInstant)
+        gi = np.flatnonzero((gtFirst <= w1) & (gtLast >= w0))
+        ti = np.flatnonzero((toFirst <= w1) & (toLast >= w0))
+        gxy = getWindowPositions(annotations, gi, w0, w1)
+        txy = getWindowPositions(objects, ti, w0, w1)
+        D = getWindowDistances(gxy, txy)
+        gLocal = {g: k for k, g in enumerate(gi)}
+        tLocal = {o: k for k, o in enumerate(ti)}
+        for t in range(w0, w1+1):
+            Dt = D[t-w0]
+            gPresent = ~np.isnan(gxy[t-w0,:,0])
+            tPresent = ~np.isnan(txy[t-w0,:,0])
+            previousMatches = matches.copy()
+            
+            # keep the matches that still exist and are within matchingDistance
+            for a, o in previousMatches.items():
+                ka, ko = gLocal.get(a), tLocal.get(o)
+                if ka is not None and ko is not None and gPresent[ka] and tPresent[ko] and Dt[ka,ko] < matchingDistance:
+                    dist += float(Dt[ka,ko])
+                else:
+                    del matches[a]
+            
+            # match the unmatched annotations and objects
+            matchedTOs = set(matches.values())
+            ug = [k for k in np.flatnonzero(gPresent) if gi[k] not in matches]
+            ut = [k for k in np.flatnonzero(tPresent) if ti[k] not in matchedTOs]
+            if len(ug) > 0 and len(ut) > 0:
+                costs = Dt[np.ix_(ug, ut)]
+                costs[costs >= matchingDistance] = matchingDistance + 1
+                for r, c in zip(*linear_sum_assignment(costs)):
+                    if costs[r,c] < matchingDistance:
+                        matches[gi[ug[r]]] = ti[ut[c]]
+                        dist += float(costs[r,c])
+            
+            # compute metrics elements
+            nGTs = int(gPresent.sum())
+            nTOs = int(tPresent.sum())
+            ct += len(matches)
+            mt += nGTs - len(matches)
+            fpt += nTOs - len(matches)
+            gt += nGTs
+            previousTOs = set(previousMatches.values())
+            for a, o in matches.items():
+                if a in previousMatches:
+                    if previousMatches[a] != o:
+                        mme += 1
+                elif o in previousTOs:
+                    mme += 1
+    motp = dist/ct if ct > 0 else None
+    mota = 1.-float(mt+fpt+mme)/gt if gt > 0 else None
+    return motp, mota, mt, mme, fpt, gt
+
 class box(object):
     def __init__(self, pMin=None, pMax=None):
         self.pMin = pMin
@@ -131,8 +295,7 @@ class ZipTraj(object):
     def asTrajectory(self, compressed=False):
         traj = self.compressed() if compressed else self.asArray()
         if traj is not None:
-            pl = [(x,y) for x,y in traj]
-            return cvmoving.Trajectory.fromPointList(pl)
+            return Trajectory(np.asarray(traj).T.tolist())
     
     def compressed(self):
         """
@@ -162,6 +325,10 @@ class MovingObject(moving.MovingObject):
             # stored as integers at a certain precision
             ptraj = ZipTraj.fromCompressed(positions, precision=precision).asTrajectory()
             vtraj = ZipTraj.fromCompressed(velocities, precision=precision).asTrajectory()
+        elif isinstance(positions, np.ndarray):
+            # floating precision, as (n,2) arrays (from CVsqlite.buildTrajectories)
+            ptraj = Trajectory(positions.T.tolist())
+            vtraj = Trajectory(velocities.T.tolist())
         else:
             # floating precision
             ptraj = Trajectory.fromPointList(positions)
@@ -235,13 +402,10 @@ class MovingObject(moving.MovingObject):
         return self.velocities.smoothed[i-self.getFirstInstant()]
     
     def distanceLength(self):
-        # go through the points and add up the norm2's
-        length = 0.
-        for i in range(0,len(self.positions)-1):
-            p0 = self.positions[i]
-            p1 = self.positions[i+1]
-            length += (p0-p1).norm2()
-        return length
+        # add up the norm2's between each pair of consecutive points
+        x = np.asarray(self.positions.positions[0], dtype=np.float64)
+        y = np.asarray(self.positions.positions[1], dtype=np.float64)
+        return float(np.hypot(np.diff(x), np.diff(y)).sum())
     
     def matches(self, obj, i, matchDistance):
         d = Point.distanceNorm2(self.getPositionAtInstant(i), obj.getPositionAtInstant(i))
@@ -251,7 +415,7 @@ class MovingObject(moving.MovingObject):
             return matchDistance + 1
     
     def setFeatures(self, features):
-        self.features = [features[i] for i in self.featureNumbers]
+        self.features = [features[i] for i in self.featureNumbers if i in features]
     
     def getFeaturesAtInstant(self, i):
         return [f for f in self.features if f.existsAtInstant(i)]
@@ -347,6 +511,16 @@ class Trajectory(moving.Trajectory):
                     seg.append(Point(self.positions[0][indx], self.positions[1][indx]))
             return seg
     
+    def asIntArray(self, stop=None, dtype=np.int32):
+        """
+        Return the points up to (not including) index stop as an (n,2) integer
+        array (truncated like Point.asint), e.g. for drawing with cv2.polylines.
+        Coordinates outside the range of dtype are clipped to it.
+        """
+        pts = np.array([self.positions[0][:stop], self.positions[1][:stop]], dtype=np.float64).T
+        info = np.iinfo(dtype)
+        return np.clip(pts, info.min, info.max).astype(dtype)
+    
 class ImageObject(object):
     def __init__(self, obj, hom, invHom, withBoxes=True, imageBoxes=True, worldBoxes=False, color='random'):
         self.obj = obj
@@ -361,12 +535,16 @@ class ImageObject(object):
         self.boundingbox = []
         self.imgBoxes = []
         self.joinedWith = []
+        self._drawAsJoined = None                          # cached drawAsJoined, reset when joinedWith changes
         self.joinedObj = None
         self.imgPos = None
+        self._intTrajCache = (None, None)                  # (imgPos, int16 array of imgPos) for drawing
         self.prevImgPos = []
         self.subObjects = []
         self.ungroupedFeatures = {}
+        self._leaves = None                                # cached list from getLeaves
         self.project()
+        self.getIntTrajectory()                            # convert for drawing now (i.e. in the loader) instead of on the first frame it is drawn
         if self.withBoxes:
             self.computeBoundingTrajectory(imageSpace=imageBoxes, worldSpace=worldBoxes)
     
@@ -379,14 +557,10 @@ class ImageObject(object):
         return "<{} {}{}>".format(self.__class__.__name__, self.obj.num, objInfo)
     
     def project(self):
-        o = self.obj.positions.homographyProject(self.invHom)
-        self.imgPos = Trajectory(o.positions)   # need to pass Trajectory constructor a list of points, not a Trajectory object
-        
-        self.obj.positions.imagespace = self.imgPos                                   # for compatibility with (old) roundabout code
-        if self.obj.features is not None:
-            for f in self.obj.features:
-                f.imgPos = Trajectory(f.positions.homographyProject(self.invHom).positions)
-                f.positions.imagespace = f.imgPos
+        # objects loaded by CVsqlite are already projected in batches (see projectObjects)
+        if getattr(self.obj.positions, 'imagespace', None) is None:
+            projectObjects([self.obj], self.invHom)
+        self.imgPos = self.obj.positions.imagespace                                  # also kept there for compatibility with (old) roundabout code
     
     def hide(self):
         """Set the hidden attribute to True."""
@@ -414,6 +588,26 @@ class ImageObject(object):
     def toInstant(self, i):
         return self.imgPos[0:self.getIndex(i)]
     
+    def toInstantArray(self, i):
+        """
+        Return the image space trajectory up to instant i as an (n,2) int16
+        array (pixel coordinates, a quarter of the size of the float positions).
+        The whole trajectory is converted once and sliced on each call, and
+        converted again only if imgPos is replaced (e.g. by join/unjoin).
+        """
+        return self.getIntTrajectory()[:max(self.getIndex(i), 0)]
+    
+    def getIntTrajectory(self):
+        """
+        Return the whole image space trajectory as an (n,2) int16 array,
+        converting it only if imgPos changed since the last call.
+        """
+        traj, pts = self._intTrajCache
+        if traj is not self.imgPos:
+            pts = self.imgPos.asIntArray(dtype=np.int16)
+            self._intTrajCache = (self.imgPos, pts)
+        return pts
+    
     def existsAtInstant(self, i):
         return self.obj.existsAtInstant(i)
     
@@ -440,6 +634,33 @@ class ImageObject(object):
             featPositions.extend([getFeaturePositionAtInstant(f, i) for f in o.getFeaturesAtInstant(i)])
         return featPositions
     
+    def getLeaves(self):
+        """
+        Return the flattened list of objects to draw for this object: just
+        this object, or if it is exploded, this object (for its ungrouped
+        features) followed by the leaves of its subObjects. The list is cached
+        until the subObjects change.
+        """
+        if self._leaves is None:
+            leaves = [self]
+            if self.isExploded:
+                for o in self.subObjects:
+                    leaves.extend(o.getLeaves())
+            self._leaves = leaves
+        return self._leaves
+    
+    def getFeatureArraysAtInstant(self, i):
+        """
+        Return the image space x and y coordinates of the features that
+        exist at instant i (the same features as getFeaturePositionsAtInstant)
+        as two arrays. Features that were not projected yet are projected
+        together with projectTrajectories.
+        """
+        feats = list(self.obj.getFeaturesAtInstant(i))
+        for o in self.joinedWith:
+            feats.extend(o.getFeaturesAtInstant(i))
+        return getFeatureArraysAtInstant(feats, i, self.invHom)
+    
     def getFeatureNumbers(self):
         featureNumbers = []
         for o in self.getObjList():
@@ -453,16 +674,21 @@ class ImageObject(object):
         """
         Return if this object should be drawn to represent all objects it is
         joined with (true if it is the object with the lowest ID number).
+        This is called for every object drawn in every frame, so the result is
+        kept until joinedWith changes.
         """
-        draw = True
-        for o in self.joinedWith:
-            if self.getNum() > o.getNum():
-                draw = False
-        return draw
+        if self._drawAsJoined is None:
+            draw = True
+            for o in self.joinedWith:
+                if self.getNum() > o.getNum():
+                    draw = False
+            self._drawAsJoined = draw
+        return self._drawAsJoined
     
     def join(self, obj):
         if obj not in self.joinedWith:
             self.joinedWith.append(obj)
+            self._drawAsJoined = None
         self.computeBoundingTrajectory()
         if self.drawAsJoined():
             self.makeJoinedObject()
@@ -475,6 +701,33 @@ class ImageObject(object):
             self.imgPos = self.prevImgPos.pop(0)
         if obj in self.joinedWith:
             self.joinedWith.pop(self.joinedWith.index(obj))
+            self._drawAsJoined = None
+        self.computeBoundingTrajectory()
+    
+    def joinAll(self, objs):
+        """
+        Join with all of the objects in objs (skipping this object), computing
+        the bounding trajectory and joined object once instead of per join.
+        """
+        for obj in objs:
+            if obj is not self and obj not in self.joinedWith:
+                self.joinedWith.append(obj)
+        self._drawAsJoined = None
+        self.computeBoundingTrajectory()
+        if self.drawAsJoined():
+            self.makeJoinedObject()
+            
+            self.prevImgPos.append(self.imgPos)
+            self.imgPos = self.joinedObj.imgPos
+    
+    def unjoinAll(self, objs):
+        """Undo joinAll, unjoining all of the objects in objs at once."""
+        if self.drawAsJoined() and len(self.prevImgPos) > 0:
+            self.imgPos = self.prevImgPos.pop(0)
+        for obj in objs:
+            if obj in self.joinedWith:
+                self.joinedWith.pop(self.joinedWith.index(obj))
+        self._drawAsJoined = None
         self.computeBoundingTrajectory()
     
     def getJoinList(self):
@@ -522,6 +775,7 @@ class ImageObject(object):
             print("Grouping object {} from features {} ...".format(oId, featureIds))
             o = ImageObject(MovingObject.fromFeatures(oId, feats), self.hom, self.invHom)
             self.subObjects.append(o)
+            self._leaves = None
             return oId, o
         else:
             print("There are no features in the region you selected!")
@@ -539,16 +793,20 @@ class ImageObject(object):
                 for f in o.obj.features:
                     if f in self.obj.features:
                         self.ungroupedFeatures[f.num] = f
+                self._leaves = None
+                break
     
     def explode(self):
         self.isExploded = True
         self.ungroupedFeatures = {f.getNum(): f for f in self.obj.features}
+        self._leaves = None
     
     def unExplode(self):
         """Undo the explode by clearing the list of subObjects."""
         self.isExploded = False
         self.subObjects = []
         self.ungroupedFeatures = {}
+        self._leaves = None
         
     def getTimeInterval(self):
         """
@@ -4,11 +4,26 @@ import os, time, datetime
 import threading, queue, multiprocessing
 import sqlite3, gzip, shutil, hashlib, re, tempfile
 from socket import gethostname
-from urllib.parse import urlparse
-from collections import OrderedDict
+from urllib.parse import urlparse, quote
+from collections import OrderedDict, deque
 import numpy as np
 from . import cvmoving
 
+# PRAGMAs for reading a whole database quickly (memory-mapped I/O, a 64 MB
+# page cache and in-memory temp tables), these don't change the database file
+SQLITE_TUNING_PRAGMAS = '''
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA temp_store=MEMORY;
+'''
+
+# PRAGMAs for databases that are also written (WAL so readers don't block each
+# other), WAL is stored in the file so these are not used for databases opened read-only
+SQLITE_WRITE_PRAGMAS = '''
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+'''
+
 def md5hash(fname):
     """Calculate the md5 hash on a file."""
     hash_md5 = hashlib.md5()
@@ -24,15 +39,13 @@ def gunzip(gzipFile, ofname=None, tmpfs='/dev/shm/'):
         of.write(gzf.read())
     return ofname
 
-def drainQueue(q):
-    out = []
-    while not q.empty():
-        try:
-            o = q.get(block=False)
-            out.append(o)
-        except queue.Empty:
-            break
-    return out
+# one row of the position/velocity queries read by CVsqlite.buildTrajectories
+TRAJECTORY_ROW_DTYPE = [('id', np.int64), ('frame', np.int64), ('x', np.float64), ('y', np.float64), ('vx', np.float64), ('vy', np.float64)]
+
+def drainDeque(buf, out):
+    """Move everything in the deque buf to the end of the list out."""
+    while buf:
+        out.append(buf.popleft())
 
 def getStoragePrecision(cameraFramePrecision, maxValue, error=0.005, nMeasures=1000, maxIters=100):
     """
@@ -48,6 +61,108 @@ def getStoragePrecision(cameraFramePrecision, maxValue, error=0.005, nMeasures=1
         i += 1
     return o
 
+# tables written by the feature grouping (the rest of a database is the feature tracking)
+OBJECT_TABLES = ['objects', 'objects_features']
+
+def mergeGroupingResults(dbFiles, outFile, prefixes):
+    """
+    Merge databases that have the same features but different groupings into
+    the single database outFile. The features are kept once and the object
+    tables of dbFiles[i] are renamed with prefixes[i] (<prefix>_objects_features,
+    etc.), so they can be loaded with CVsqlite(outFile, objTablePrefix=prefix).
+    The merged database files are removed.
+    """
+    os.replace(dbFiles[0], outFile)
+    connection = sqlite3.connect(outFile)
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    tableNames = [tn[0] for tn in cursor]
+    for tn in OBJECT_TABLES:
+        if tn in tableNames:
+            cursor.execute("ALTER TABLE {tn} RENAME TO {p}_{tn};".format(p=prefixes[0], tn=tn))
+    connection.commit()
+    for dbf, prefix in zip(dbFiles[1:], prefixes[1:]):
+        cursor.execute("ATTACH DATABASE ? AS src;", (dbf,))
+        cursor.execute("SELECT name, sql FROM src.sqlite_master WHERE type='table';")
+        tableSql = dict(cursor.fetchall())
+        for tn in OBJECT_TABLES:
+            if tn in tableSql:
+                # create the table with its original schema (CREATE TABLE ... AS SELECT would drop the primary key)
+                createSql = re.sub(r'^CREATE TABLE\s+["`\[]?{tn}["`\]]?'.format(tn=tn), 'CREATE TABLE {p}_{tn}'.format(p=prefix, tn=tn), tableSql[tn], count=1, flags=re.IGNORECASE)
+                cursor.execute(createSql)
+                cursor.execute("INSERT INTO {p}_{tn} SELECT * FROM src.{tn};".format(p=prefix, tn=tn))
+        connection.commit()
+        cursor.execute("DETACH DATABASE src;")
+        os.remove(dbf)
+    connection.close()
+
+# where annotations with their centroid trajectories are cached (see CVsqlite.loadAnnotationArrays)
+ANNOTATION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cvgui')
+ANNOTATION_ARRAYS = ['nums', 'offsets', 'frames', 'xs', 'ys']
+
+def annotationsToArrays(annotations):
+    """
+    Flatten the (centroid) trajectories of the annotations into a dict of
+    arrays in CSR layout: annotation k has number nums[k] and its frames and
+    positions are frames, xs and ys [offsets[k]:offsets[k+1]].
+    """
+    offsets = np.zeros(len(annotations)+1, dtype=np.int32)
+    offsets[1:] = np.cumsum([int(a.length()) for a in annotations])
+    return {'nums': np.array([a.getNum() for a in annotations], dtype=np.int32),
+            'offsets': offsets,
+            'frames': np.concatenate([np.empty(0)] + [np.arange(a.getFirstInstant(), a.getLastInstant()+1) for a in annotations]).astype(np.int32),
+            'xs': np.concatenate([np.empty(0)] + [a.getXCoordinates() for a in annotations]).astype(np.float32),
+            'ys': np.concatenate([np.empty(0)] + [a.getYCoordinates() for a in annotations]).astype(np.float32)}
+
+def annotationsFromArrays(arrays):
+    """Rebuild (lightweight) annotation objects from the arrays made by annotationsToArrays."""
+    annotations = []
+    offsets = arrays['offsets']
+    for k, num in enumerate(arrays['nums']):
+        s, e = offsets[k], offsets[k+1]
+        tInt = cvmoving.TimeInterval(int(arrays['frames'][s]), int(arrays['frames'][e-1]))
+        traj = cvmoving.Trajectory([arrays['xs'][s:e].tolist(), arrays['ys'][s:e].tolist()])
+        annotations.append(cvmoving.MovingObject(int(num), timeInterval=tInt, positions=traj))
+    return annotations
+
+def getAnnotationCacheFile(dbFile, tableName, homography, cacheDir=ANNOTATION_CACHE_DIR):
+    """
+    Name of the annotation cache file for the table tableName of dbFile with
+    the given homography (the key includes the size and modification time of
+    the database file, so the cache is not used if the file changes).
+    """
+    st = os.stat(dbFile)
+    key = hashlib.sha1()
+    key.update("{}:{}:{}:{}".format(os.path.abspath(dbFile), st.st_size, st.st_mtime_ns, tableName).encode())
+    key.update(np.ascontiguousarray(homography, dtype=np.float64).tobytes())
+    return os.path.join(cacheDir, 'ann_{}.npz'.format(key.hexdigest()))
+
+def saveAnnotationCache(fname, arrays, firstFrame, lastFrame):
+    cacheDir = os.path.dirname(fname)
+    os.makedirs(cacheDir, exist_ok=True)
+    # write to a temporary file and move it into place, so an interrupted run
+    # can't leave a truncated file under the final name
+    with tempfile.NamedTemporaryFile(dir=cacheDir, suffix='.npz.tmp', delete=False) as tmpf:
+        try:
+            np.savez(tmpf, firstFrame=firstFrame, lastFrame=lastFrame, **arrays)
+        except:
+            os.remove(tmpf.name)
+            raise
+    os.replace(tmpf.name, fname)
+
+def loadAnnotationCache(fname):
+    """
+    Load an annotation cache file, returning arrays, firstFrame, lastFrame
+    (or None if it can't be read, so it is treated as a cache miss).
+    """
+    try:
+        with np.load(fname) as d:
+            arrays = {k: d[k] for k in ANNOTATION_ARRAYS}
+            return arrays, int(d['firstFrame']), int(d['lastFrame'])
+    except Exception as e:
+        print("Could not read annotation cache file {} ({}), recomputing the annotations".format(fname, e))
+        return None
+
 class GZfile(object):
     """A class for managing writable, gzipped file."""
     def __init__(self, filename, tmpfs='/dev/shm'):
@@ -113,7 +228,7 @@ class GZfile(object):
 
 class CVsqlite(object):
     """A class for interacting with an sqlite database of computer vision data."""
-    def __init__(self, filename, withFeatures=True, objTablePrefix=None, homography=None, invHom=None, withImageBoxes=False, allFeatures=False, objFetchSize=10, compressed=False, precision=0.01):
+    def __init__(self, filename, withFeatures=True, objTablePrefix=None, homography=None, invHom=None, withImageBoxes=False, allFeatures=False, objFetchSize=10, compressed=False, precision=0.01, tuned=False, readOnce=False, gzdb=None):
         self.filename = filename
         self.withFeatures = withFeatures
         self.objTablePrefix = objTablePrefix.rstrip('_') if objTablePrefix is not None else ''
@@ -124,10 +239,13 @@ class CVsqlite(object):
         self.objFetchSize = objFetchSize
         self.compressed = compressed
         self.precision = precision
+        self.tuned = tuned
+        self.readOnce = readOnce
+        self.adviceFd = None
         
         self.fname, self.fext = os.path.splitext(os.path.basename(filename))
         self.isZipped = self.fext == '.gz'
-        self.gzdb = None
+        self.gzdb = gzdb                                # a GZfile already inflated from filename (if it was unzipped ahead of time)
         self.dbFile = None
         self.features = []
         self.objects = []
@@ -136,12 +254,19 @@ class CVsqlite(object):
         self.annotations = []
         self.tableInfo = {}
         self.lastFrame = None
+        self.frameRange = None
         self.firstObjId, self.lastObjId = -1, -1
         
         self.thread = None
+        self.featureDB = None
+        self.loadFinished = False
         self.objectQueue = multiprocessing.Queue()
         self.featureQueue = multiprocessing.Queue()
         self.imageObjectQueue = multiprocessing.Queue()
+        self.featureBuffer = deque()                    # filled from the queues by the reader threads,
+        self.objectBuffer = deque()                     # so update() doesn't wait on (or unpickle from) the queues
+        self.imageObjectBuffer = deque()
+        self.readers = []
         
         self.latestannotations = ''
         self.boundingbox = []
@@ -186,42 +311,25 @@ class CVsqlite(object):
         from a database cursor. You must execute a query on the cursor before
         executing this function.
         """
-        # initialize
-        objId = -1
-        obj = None
         trajectories = {} if returnDict else []
         
-        # iterate over the rows in the query result
-        currentObjId = None
-        positions = []
-        velocities = []
-        firstInstant, lastInstant = 0, -1
-        for row in cursor:
-            objId, i, x, y, vx, vy = row
-            if objId != currentObjId:         # if the object ID is different, we should start a new object
-                if len(positions) > 0:
-                    # construct object that has ended and place in trajectories
-                    # if the trajectories are compressed and at a fixed precision,
-                    # they will be transformed into floating point values
-                    obj = cvmoving.MovingObject.fromTableRows(currentObjId, firstInstant, lastInstant, positions, velocities, featureNumbers=featureNumbers, compressed=self.compressed, precision=self.precision)
-                    if returnDict:
-                        trajectories[currentObjId] = obj
-                    else:
-                        trajectories.append(obj)
-                    positions = []
-                    velocities = []
-                
-                currentObjId = objId
-                firstInstant = i
-            lastInstant = i
-            positions.append((x,y))
-            velocities.append((vx,vy))
-        
-        # add the last object to the list
-        if len(positions) > 0:
-            obj = cvmoving.MovingObject.fromTableRows(currentObjId, firstInstant, lastInstant, positions, velocities, featureNumbers=featureNumbers, compressed=self.compressed, precision=self.precision)
+        # read the rows straight into one array (columns: object ID, frame, x, y, vx, vy)
+        # instead of building a tuple for every point of every object
+        rows = np.fromiter(cursor, dtype=TRAJECTORY_ROW_DTYPE)
+        if len(rows) == 0:
+            return trajectories
+        positions = np.column_stack([rows['x'], rows['y']])
+        velocities = np.column_stack([rows['vx'], rows['vy']])
+        
+        # the rows are sorted by object ID, so each object is a block of rows
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(rows['id'])) + 1, [len(rows)]])
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            # if the trajectories are compressed and at a fixed precision,
+            # they will be transformed into floating point values
+            objId = int(rows['id'][a])
+            obj = cvmoving.MovingObject.fromTableRows(objId, int(rows['frame'][a]), int(rows['frame'][b-1]), positions[a:b], velocities[a:b], featureNumbers=featureNumbers, compressed=self.compressed, precision=self.precision)
             if returnDict:
-                trajectories[currentObjId] = obj
+                trajectories[objId] = obj
             else:
                 trajectories.append(obj)
         return trajectories
@@ -236,11 +344,25 @@ class CVsqlite(object):
     def open(self):
         """Open the database, unzipping it first if necessary."""
         if self.isZipped:
-            self.gzdb = GZfile(self.filename)
+            if self.gzdb is None:
+                self.gzdb = GZfile(self.filename)
             self.dbFile = self.gzdb.getFileName()
         else:
             self.dbFile = self.filename
-        self.connection = sqlite3.connect(self.dbFile)
+        if self.readOnce:
+            # the database is only read, so open it read-only (it can then be in a read-only location)
+            self.connection = sqlite3.connect('file:{}?mode=ro'.format(quote(os.path.abspath(self.dbFile))), uri=True)
+        else:
+            self.connection = sqlite3.connect(self.dbFile)
+        if self.tuned:
+            self.connection.executescript(SQLITE_TUNING_PRAGMAS)
+            if not self.readOnce:
+                self.connection.executescript(SQLITE_WRITE_PRAGMAS)
+        if self.readOnce and hasattr(os, 'posix_fadvise'):
+            # the file will be read through once, so tell the kernel to read ahead
+            # (sqlite doesn't expose its file descriptor, so use our own)
+            self.adviceFd = os.open(self.dbFile, os.O_RDONLY)
+            os.posix_fadvise(self.adviceFd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
         
     def close(self):
         """
@@ -251,9 +373,16 @@ class CVsqlite(object):
         self.connection.commit()
         self.connection.close()
         
+        # drop the file from the page cache if it won't be read again
+        if self.adviceFd is not None:
+            os.posix_fadvise(self.adviceFd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(self.adviceFd)
+            self.adviceFd = None
+        
         # replace zip file if zipped
         if self.isZipped:
             self.gzdb.close()
+            self.gzdb = None
     
     def compressTrajectories(self, precision=None):
         """
@@ -321,6 +450,29 @@ class CVsqlite(object):
     
     loadAnnotaion = loadAnnotations
     
+    def computeCentroidTrajectories(self, homography=None):
+        """
+        Compute the centroid trajectory of all the annotations at once (same
+        result as calling computeCentroidTrajectory on each of them), projecting
+        all the bounding box centers with a single matrix product.
+        """
+        if len(self.annotations) == 0:
+            return
+        bb = np.array(self.boundingbox, dtype=np.float64)
+        P = np.ones((bb.shape[0], 3))
+        P[:,0] = (bb[:,2] + bb[:,4]) / 2.
+        P[:,1] = (bb[:,3] + bb[:,5]) / 2.
+        if homography is not None:
+            P = P.dot(np.asarray(homography).T)
+            P[:,:2] /= P[:,2:3]
+        
+        # rows are sorted by object ID then frame, so each annotation is a contiguous slice
+        objIds = bb[:,0]
+        for a in self.annotations:
+            start = np.searchsorted(objIds, a.getNum(), side='left')
+            stop = np.searchsorted(objIds, a.getNum(), side='right')
+            a.positions = cvmoving.Trajectory([P[start:stop,0].tolist(), P[start:stop,1].tolist()])
+    
     def tableToObject(self,table):
         objId = -1
         obj = None
@@ -346,17 +498,50 @@ class CVsqlite(object):
     
     def createBoundingBoxTable(self, annotation, invHomography = None):
         '''Create the table to store the object bounding boxes in image space
+        (only read into self.boundingbox, nothing is written to the database,
+        the final annotation arrays are cached by loadAnnotationArrays instead)
         '''
         cursor = self.connection.cursor()
         try:
             cursor.execute('SELECT object_id, frame_number, min(x), min(y), max(x), max(y) from '
                   '(SELECT object_id, frame_number, (x*{}+y*{}+{})/w as x, (x*{}+y*{}+{})/w as y from '
                   '(SELECT OF.object_id, P.frame_number, P.x_coordinate as x, P.y_coordinate as y, P.x_coordinate*{}+P.y_coordinate*{}+{} as w from positions P, {} OF WHERE P.trajectory_id = OF.trajectory_id)) '.format(invHomography[0,0], invHomography[0,1], invHomography[0,2], invHomography[1,0], invHomography[1,1], invHomography[1,2], invHomography[2,0], invHomography[2,1], invHomography[2,2], annotation)+
-                  'GROUP BY object_id, frame_number')
+                  'GROUP BY object_id, frame_number ORDER BY 1, 2')
         except sqlite3.OperationalError as error:
             raise
         self.boundingbox = cursor.fetchall ()
     
+    def loadAnnotationArrays(self, homography, tableName=None, cacheDir=ANNOTATION_CACHE_DIR, invHomography=None):
+        """
+        Load the annotations in table tableName (the latest one if None) with
+        their centroid trajectories as arrays (see annotationsToArrays).
+        The result is cached in cacheDir (None to disable the cache) so later
+        runs on the same database, table and homography skip all the SQL and
+        per-object work. Returns arrays, firstFrame, lastFrame.
+        """
+        if tableName is None:
+            self.getLatestAnnotation()
+            tableName = self.latestannotations
+        cacheFile = None
+        if cacheDir is not None:
+            cacheFile = getAnnotationCacheFile(self.filename, tableName, homography, cacheDir)
+            if os.path.exists(cacheFile):
+                cached = loadAnnotationCache(cacheFile)
+                if cached is not None:
+                    return cached
+        # NOTE this way of inverting the homography leaves out the conversion from
+        # homogeneous coordinates, but it matches TrafficIntelligence
+        if invHomography is None:
+            invHomography = np.linalg.inv(homography)
+        self.createBoundingBoxTable(tableName, invHomography)
+        self.loadAnnotations()
+        self.computeCentroidTrajectories(homography)
+        frameNumbers = self.getFrameList()
+        arrays = annotationsToArrays(self.annotations)
+        if cacheFile is not None:
+            saveAnnotationCache(cacheFile, arrays, frameNumbers[0], frameNumbers[-1])
+        return arrays, frameNumbers[0], frameNumbers[-1]
+    
     def getLatestAnnotation(self):
         """Determine the latest annotation table. Return False if no
         annotations are found and True otherwise. The latestannotations is
@@ -461,12 +646,44 @@ class CVsqlite(object):
         """
         Update the object lists from the queues.
         """
-        for f in drainQueue(self.featureQueue):
-            self.features.append(f)
-        for o in drainQueue(self.objectQueue):
-            self.objects.append(o)
-        for io in drainQueue(self.imageObjectQueue):
-            self.imageObjects.append(io)
+        # once the queues are all read and emptied there is nothing left to do
+        if self.loadFinished:
+            return
+        finished = len(self.readers) > 0 and not any(t.is_alive() for t in self.readers)        # check before draining, so nothing can be added after the drain
+        drainDeque(self.featureBuffer, self.features)
+        drainDeque(self.objectBuffer, self.objects)
+        drainDeque(self.imageObjectBuffer, self.imageObjects)
+        self.loadFinished = finished
+    
+    def loadersFinished(self):
+        """
+        Return True if the loader processes have all exited (so all of their
+        objects are already in the queues).
+        """
+        loaders = [self.thread] if self.featureDB is None else [self.thread, self.featureDB.thread]
+        return all(isinstance(t, multiprocessing.Process) and t.exitcode is not None for t in loaders)
+    
+    def startQueueReaders(self):
+        """
+        Start a thread for each queue that moves the objects from the loaders
+        into a deque as they arrive (see update).
+        """
+        self.readers = []
+        for q, buf in [(self.featureQueue, self.featureBuffer), (self.objectQueue, self.objectBuffer), (self.imageObjectQueue, self.imageObjectBuffer)]:
+            t = threading.Thread(target=self._readQueue, args=(q, buf), name='QueueReader')
+            t.daemon = True
+            t.start()
+            self.readers.append(t)
+    
+    def _readQueue(self, q, buf):
+        """Read the queue q into the deque buf until the loaders have finished and it is empty."""
+        while True:
+            finished = self.loadersFinished()               # check before reading, so nothing can be queued after a read finds the queue empty
+            try:
+                buf.append(q.get(timeout=0.5))
+            except queue.Empty:
+                if finished:
+                    break
     
     def loadObjectsInThread(self, sameProcess=False):
         """
@@ -480,9 +697,12 @@ class CVsqlite(object):
         self.thread.start()
         
         if self.allFeatures:
-            self.featureDB = CVsqlite(self.filename, withFeatures=self.withFeatures, objTablePrefix=self.objTablePrefix, homography=self.homography, invHom=self.invHom, withImageBoxes=self.withImageBoxes, allFeatures=self.allFeatures, objFetchSize=self.objFetchSize, compressed=self.compressed, precision=self.precision)
+            self.featureDB = CVsqlite(self.filename, withFeatures=self.withFeatures, objTablePrefix=self.objTablePrefix, homography=self.homography, invHom=self.invHom, withImageBoxes=self.withImageBoxes, allFeatures=self.allFeatures, objFetchSize=self.objFetchSize, compressed=self.compressed, precision=self.precision, tuned=self.tuned)
             self.featureDB.featureQueue = self.featureQueue
             self.featureDB.loadFeaturesInThread()
+        
+        # start reading the queues after starting the loaders (so they aren't forked with the reader threads running)
+        self.startQueueReaders()
     
     def loadFeaturesInThread(self, sameProcess=False):
         """
@@ -520,17 +740,27 @@ class CVsqlite(object):
         cursor.execute(pvQuery)
         self.features = self.buildTrajectories(cursor)
         if useQueue:
+            # project the features for the player here, ahead of the frames they are drawn in
+            # (instead of in the player the first time each one appears)
+            if self.invHom is not None and len(self.features) > 0:
+                for f, imgPos in zip(self.features, cvmoving.projectTrajectories([f.positions for f in self.features], self.invHom)):
+                    f.imgPos = imgPos
             for f in self.features:
                 self.featureQueue.put(f)
         
-    def loadObjects(self, objTablePrefix=None):
+    def loadObjects(self, objTablePrefix=None, frameRange=None):
         """
         Load object positions and velocities from the database into a list.
         Any objTablePrefix provided here will overwrite the object's current
-        objTablePrefix property.
+        objTablePrefix property. If frameRange (first, last) is given, only
+        the positions in those frames are loaded (objects that don't exist in
+        them are skipped).
         """
         if objTablePrefix is not None:
-            self.objTablePrefix = objTablePrefix
+            self.objTablePrefix = objTablePrefix.rstrip('_')
+        self.frameRange = frameRange
+        # start from the first object again (so other object tables can be loaded with the same connection)
+        self.firstObjId, self.lastObjId = -1, -1
         self._loadObjects(useQueue=False)
         
     def _loadObjects(self, useQueue=True):
@@ -542,6 +772,9 @@ class CVsqlite(object):
         otp = self.objTablePrefix + '_' if len(self.objTablePrefix) > 0 else ''
         self.objTableName = otp + 'objects_features'
         
+        # only read the positions in frameRange (if set)
+        frameFilter = 'AND p.frame_number BETWEEN {} AND {}'.format(*self.frameRange) if self.frameRange is not None else ''
+        
         # get the objects
         cursor = self.connection.cursor()
         
@@ -554,14 +787,15 @@ class CVsqlite(object):
                 self.featureNumbers[oid] = []
             self.featureNumbers[oid].append(fid)
         
-        # now read in the objects and features in chunks
+        # now read in the objects and features in chunks (clearing any loaded from
+        # another table first, even if this one is empty)
+        self.objects = []
+        self.oidKeyedObjects = {}
+        self.imageObjects = []
         if len(self.featureNumbers.keys()) == 0:
             return
         else :
             self.maxObjId = max(self.featureNumbers.keys())
-        self.objects = []
-        self.oidKeyedObjects = {}
-        self.imageObjects = []
         while self.lastObjId < self.maxObjId:
             # set the object number range
             self.firstObjId = self.lastObjId + 1
@@ -580,8 +814,9 @@ class CVsqlite(object):
                                 AND o.trajectory_id=v.trajectory_id
                                 AND p.frame_number=v.frame_number
                                 AND o.object_id BETWEEN {first} AND {last}
+                                {ff}
                             GROUP BY o.object_id,p.frame_number
-                            ORDER BY o.object_id,p.frame_number;'''.format(otn=self.objTableName, first=self.firstObjId, last=self.lastObjId)
+                            ORDER BY o.object_id,p.frame_number;'''.format(otn=self.objTableName, first=self.firstObjId, last=self.lastObjId, ff=frameFilter)
                 cursor.execute(objQuery)
                 objects = self.buildTrajectories(cursor, featureNumbers=self.featureNumbers, returnDict=True)
             
@@ -602,19 +837,31 @@ class CVsqlite(object):
                                 WHERE p.trajectory_id=v.trajectory_id
                                 AND p.frame_number=v.frame_number
                                 AND p.trajectory_id IN ({fnums})
-                                ORDER BY p.trajectory_id,p.frame_number;'''.format(fnums=','.join(map(str,fnums)))
+                                {ff}
+                                ORDER BY p.trajectory_id,p.frame_number;'''.format(fnums=','.join(map(str,fnums)), ff=frameFilter)
                 
                 # assemble the features and assign them to objects
                 cursor.execute(featQuery)
                 features = self.buildTrajectories(cursor, returnDict=True)
+                chunkObjects = []
                 for oid in range(self.firstObjId, self.lastObjId+1):
                     if not self.compressed:
+                        if oid not in objects:
+                            continue
                         o = objects[oid]
                         if hasattr(o, 'featureNumbers'):
                             o.setFeatures(features)
                     else:
-                        ofeats = [features[fid] for fid in self.featureNumbers[oid]]
+                        ofeats = [features[fid] for fid in self.featureNumbers.get(oid, []) if fid in features]
+                        if len(ofeats) == 0:
+                            continue
                         o = cvmoving.MovingObject.fromFeatures(oid, ofeats)
+                    chunkObjects.append(o)
+                
+                # project the whole chunk into image space at once
+                if self.homography is not None and self.invHom is not None:
+                    cvmoving.projectObjects(chunkObjects, self.invHom)
+                for o in chunkObjects:
                     self.objects.append(o)
                     if useQueue:
                         self.objectQueue.put(o)
@@ -625,8 +872,8 @@ class CVsqlite(object):
                             self.imageObjectQueue.put(io)
             else:
                 for oid in range(self.firstObjId, self.lastObjId+1):
-                    o = objects[oid]
-                    self.objects.append(o)
+                    if oid in objects:
+                        self.objects.append(objects[oid])
     
     # TODO fix this to reflect changes
     #def loadAnnotations(self, objTablePrefix):
@@ -691,7 +938,9 @@ class CVsqlite(object):
             success = True
         except sqlite3.IntegrityError as error:
             # data is already there, no need to do any more
+            # (roll back so rows from the other insert aren't committed later by close())
             print(error)
+            self.connection.rollback()
         return success
     
     def writeFeatures(self, features):
@@ -724,5 +973,7 @@ class CVsqlite(object):
             success = True
         except sqlite3.IntegrityError as error:
             # data is already there, no need to do any more
+            # (roll back so rows from the other insert aren't committed later by close())
             print(error)
+            self.connection.rollback()
         return success
@@ -119,8 +119,10 @@ class featureTrackerPlayer(cvgui.cvPlayer):
         self.removeShadows = removeShadows
         self.lastFrameDrawn = -1
         self.fgmask = None
+        self.rawFgmask = None
         self.fgframe = None
         self.grayImg = None
+        self.frameGray = None
         self.times = []
         self.frameQueue = multiprocessing.Queue()
         self.fgmaskQueue = multiprocessing.Queue()
@@ -146,6 +148,10 @@ class featureTrackerPlayer(cvgui.cvPlayer):
         
         # for classifying features
         self.roadAngle = None
+        self.stablePoints = []
+        self.unstablePoints = []
+        self.stableColor = cvgui.getColorCode('blue')
+        self.unstableColor = cvgui.getColorCode('red')
         
     def open(self):
         self.openWindow()
@@ -182,20 +188,29 @@ class featureTrackerPlayer(cvgui.cvPlayer):
         Use the background subtractor to generate a foreground mask, then
         apply a Gaussian filter to remove small patches of background.
         """
-        fgmask = self.backSub.apply(self.img)
-        return cv2.GaussianBlur(fgmask, (11, 11), 0)
+        self.rawFgmask = self.backSub.apply(self.frameGray, self.rawFgmask)
+        if self.removeShadows:
+            # shadows are marked 127 by the subtractor, threshold them out in place before blurring
+            cv2.threshold(self.rawFgmask, 200, 255, cv2.THRESH_BINARY, dst=self.rawFgmask)
+        return cv2.GaussianBlur(self.rawFgmask, (11, 11), 0, dst=self.fgmask)
     
     def getForegroundFrame(self):
         self.fgmask = self.getForegroundMask()
-        if self.removeShadows:
-            self.fgmask[self.fgmask==127] = 0
         self.img = cv2.bitwise_and(self.img, self.img, mask=self.fgmask)
     
     def getGrayImage(self):
+        """
+        Convert the frame to grayscale (once per frame, the background subtractor
+        uses it too), then mask it with the detection region for the feature tracker.
+        """
         if self.grayImg is not None:
             self.lastGrayImage = self.grayImg.copy()
-        mimg = self.img if self.detectionRegion is None else cv2.bitwise_and(self.img, self.img, mask=self.detectionRegion)
-        self.grayImg = cv2.cvtColor(mimg, cv2.COLOR_BGR2GRAY)
+        if self.img.ndim == 2:
+            # the capture already gives us single-channel frames, nothing to convert
+            self.frameGray = self.img
+        else:
+            self.frameGray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY, dst=self.frameGray)
+        self.grayImg = self.frameGray if self.detectionRegion is None else cv2.bitwise_and(self.frameGray, self.frameGray, mask=self.detectionRegion)
     
     def resetTracks(self):
         """Clear targets to reset the feature tracker (after jumps and stuff)"""
@@ -253,8 +268,21 @@ class featureTrackerPlayer(cvgui.cvPlayer):
         if self.lastDetectionFrame == -1 or (self.posFrames-self.lastDetectionFrame) >= self.detectionInterval:
             self.getNewTracks()
         
+    def drawFeaturePoints(self, points, color, size=12):
+        """
+        Draw all the points at once as dots, using a single polylines call (each
+        point is a zero-length segment, which is drawn as a round dot of
+        diameter size) rather than one circle call per point.
+        """
+        if len(points) > 0:
+            pts = np.repeat(np.array(points, dtype=np.int32), 2, axis=0).reshape(-1, 2, 2)
+            cv2.polylines(self.img, list(pts), False, color, thickness=size)
+    
     def drawTrack(self, t, perturb=20):
-        """Draw a track as a line leading up to a point."""
+        """
+        Classify the feature at the end of a track as stable or unstable (the
+        points are drawn all together by drawFeaturePoints).
+        """
         if len(t.points) >= self.minFeatureTime and t.lastVel is not None and t.lastVel.norm2() > 1:
             # TODO move most of this to another method
             r = int(round(t.lastPos.y))
@@ -289,13 +317,13 @@ class featureTrackerPlayer(cvgui.cvPlayer):
                             # if drawing from Track object
                             #self.drawPoint(cvgeom.imagepoint(p.x, p.y, index=t.trackId, color=t.color))
                             #cv2.circle(self.img, p.asTuple(), 4, cvgui.getColorCode('blue'), thickness=4)
-                            cv2.circle(self.img, tuple(map(int, (c,r))), 4, cvgui.getColorCode('blue'), thickness=4)
+                            self.stablePoints.append((c,r))
                     # draw unstable features in red
                     else:
                         if len(t.points) >= 1:
                             p = t.points[-1]
                             #cv2.circle(self.img, p.asTuple(), 4, cvgui.getColorCode('red'), thickness=4)
-                            cv2.circle(self.img, tuple(map(int, (c,r))), 4, cvgui.getColorCode('red'), thickness=4)
+                            self.unstablePoints.append((c,r))
                 
                 # TODO group features, etc.
         
@@ -315,10 +343,14 @@ class featureTrackerPlayer(cvgui.cvPlayer):
         #self.img = self.fgframe.copy()
         
         # plot all the tracks
+        self.stablePoints = []
+        self.unstablePoints = []
         if len(self.tracks) > 0:
             #print(len(self.tracks))
             for t in self.tracks:
                 self.drawTrack(t)
+        self.drawFeaturePoints(self.stablePoints, self.stableColor)
+        self.drawFeaturePoints(self.unstablePoints, self.unstableColor)
                 
         self.lastFrameDrawn = self.posFrames
     
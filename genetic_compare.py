@@ -4,34 +4,21 @@ import os, sys, subprocess
 import argparse
 import subprocess
 import timeit
-from multiprocessing import Queue, Lock
 from configobj import ConfigObj
-from numpy import loadtxt
-from numpy.linalg import inv
 import matplotlib.pyplot as plt
-import moving
-from cvguipy import trajstorage, cvgenetic
+from cvguipy import trajstorage, cvgenetic, cvconfig, cvhomog, cvmoving
 
 """compare all precreated sqlite (by cfg_combination.py) with annotated version using genetic algorithm"""
 # class for genetic algorithm
 class GeneticCompare(object):
-    def __init__(self, motalist, IDlist, lock):
-        self.motalist = motalist
-        self.IDlist = IDlist
-        self.lock = lock
-        
     # This is used for calculte fitness of individual in genetic algorithm
     def computeMOT(self, i):
-        obj = trajstorage.CVsqlite(sqlite_files+str(i)+".sqlite")
-        obj.loadObjects()
-        motp, mota, mt, mme, fpt, gt = moving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
-        self.lock.acquire()
-        self.IDlist.put(i)
-        self.motalist.put(mota)
+        obj = trajstorage.CVsqlite(sqlite_files+str(i)+".sqlite", tuned=True, readOnce=True)
+        obj.loadObjects(frameRange=(firstFrame, lastFrame))
+        motp, mota, mt, mme, fpt, gt = cvmoving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
         obj.close()
         if args.PrintMOTA:
             print("ID", i, " : ", mota)
-        self.lock.release()
         return mota
         
 if __name__ == '__main__' :
@@ -48,16 +35,15 @@ if __name__ == '__main__' :
     start = timeit.default_timer()
     
     dbfile = args.databaseFile;
-    homography = loadtxt(args.homography)
+    homography, invHomography = cvhomog.loadHomography(args.homography)
     sqlite_files = "sql_files/Sqlite_ID_"
     
     cdb = trajstorage.CVsqlite(dbfile)
     cdb.open()
     cdb.getLatestAnnotation()
-    cdb.createBoundingBoxTable(cdb.latestannotations, inv(homography))
+    cdb.createBoundingBoxTable(cdb.latestannotations, invHomography)
     cdb.loadAnnotaion()
-    for a in cdb.annotations:
-        a.computeCentroidTrajectory(homography)
+    cdb.computeCentroidTrajectories(homography)
     print("Latest Annotaions in "+dbfile+": ", cdb.latestannotations)
     # for row in cdb.boundingbox:
     #     print(row)
@@ -65,15 +51,9 @@ if __name__ == '__main__' :
     firstFrame = cdb.frameNumbers[0]
     lastFrame = cdb.frameNumbers[-1]
     
-    # put calculated itmes into a Queue
-    foundmota = Queue()
-    IDs = Queue()
-    lock = Lock()
-    
-    Comp = GeneticCompare(foundmota, IDs, lock)
+    Comp = GeneticCompare()
     config = ConfigObj('range.cfg')
-    cfg_list = cfgcomb.CVConfigList()
-    cfgcomb.config_to_list(cfg_list, config)
+    cfg_list = cvconfig.config_to_table(config)
     if args.accuracy != None:
         GeneticCal = cvgenetic.CVGenetic(args.population, cfg_list, Comp.computeMOT, args.accuracy)
     else:
@@ -83,9 +63,10 @@ if __name__ == '__main__' :
     else:
         GeneticCal.run_thread()
     
-    # tranform queues to lists
-    foundmota = cvgenetic.Queue_to_list(foundmota)
-    IDs = cvgenetic.Queue_to_list(IDs)
+    # the fitness (mota) of every calculated ID is kept in the genetic calculator's store
+    results = GeneticCal.store.items()
+    IDs = [i for i, mota in results]
+    foundmota = [mota for i, mota in results]
 
     Best_mota = max(foundmota)
     Best_ID = IDs[foundmota.index(Best_mota)]
@@ -5,13 +5,9 @@ import argparse
 import subprocess
 import threading
 import timeit
-from multiprocessing import Queue, Lock
 from configobj import ConfigObj
-from numpy import loadtxt
-from numpy.linalg import inv
 import matplotlib.pyplot as plt
-import moving
-from cvguipy import trajstorage, cvgenetic, cvconfig
+from cvguipy import trajstorage, cvgenetic, cvconfig, cvhomog, cvmoving
 
 """ This script uses genetic algorithm to search for the best configuration (precreated sqlites are not needed)"""
 # TODO NOTE - This can be merge into genetic_compare with an option to create sqlite_files and cfg_files before running computeMOT
@@ -19,11 +15,8 @@ from cvguipy import trajstorage, cvgenetic, cvconfig
 
 # class for genetic algorithm
 class GeneticCompare(object):
-    def __init__(self, motalist, IDlist, cfg_list, lock):
-        self.motalist = motalist
-        self.IDlist = IDlist
+    def __init__(self, cfg_list):
         self.cfg_list = cfg_list
-        self.lock = lock
     
     # This is used for calculte fitness of individual in genetic algorithn.
     # It is modified to create sqlite and cfg file before tuning computeClearMOT.
@@ -33,30 +26,22 @@ class GeneticCompare(object):
         # create sqlite and cfg file with id i
         cfg_name = config_files +str(i)+'.cfg'
         sql_name = sqlite_files +str(i)+'.sqlite'
-        open(cfg_name,'w').close()
-        config = ConfigObj(cfg_name)
-        cfg_list.write_config(i ,config)
-        command = ['cp', 'tracking_only.sqlite', sql_name]
-        process = subprocess.Popen(command)
-        process.wait()
+        cvconfig.write_config_file(cfg_list, i, cfg_name)
+        cvconfig.copy_file_to_all('tracking_only.sqlite', sql_name)
         command = ['trajextract.py', args.inputVideo, '-o', args.homography, '-t', cfg_name, '-d', sql_name, '--gf']
         # suppress output of grouping extraction
         devnull = open(os.devnull, 'wb')
         process = subprocess.Popen(command, stdout = devnull)
         process.wait()
         
-        obj = trajstorage.CVsqlite(sql_name)
+        obj = trajstorage.CVsqlite(sql_name, tuned=True, readOnce=True)
         print("loading", i)
-        obj.loadObjects()
-        motp, mota, mt, mme, fpt, gt = moving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
+        obj.loadObjects(frameRange=(firstFrame, lastFrame))
+        motp, mota, mt, mme, fpt, gt = cvmoving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
         
-        self.lock.acquire()
-        self.IDlist.put(i)
-        self.motalist.put(mota)
         obj.close()
         if args.PrintMOTA:
             print("ID", i, " : ", mota)
-        self.lock.release()
             
         return mota
         
@@ -104,14 +89,15 @@ if __name__ == '__main__' :
             sys.exit(1)
         else:
             videofile=args.inputVideo
-            if 'avi' in videofile:
+            videoName, videoExt = os.path.splitext(videofile)
+            if videoExt.lower() == '.avi':
                 if args.maskFilename is not None:
                     command = ['trajextract.py',args.inputVideo,'-m', args.maskFilename,'-o', args.homography]
                 else:
                     command = ['trajextract.py',args.inputVideo,'-o', args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
-                databaseFile = videofile.replace('avi','sqlite')
+                databaseFile = videoName + '.sqlite'
                 command = ['cvplayer.py',args.inputVideo,'-d',databaseFile,'-o',args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
@@ -121,6 +107,7 @@ if __name__ == '__main__' :
     else:
         databaseFile = args.databaseFile
     thread_cfgtolist.join()
+    cfg_list = cvconfig.CVConfigTable.from_list(cfg_list)
     # ------------------Done initialization for annotation-------------------- #
     
     # create first tracking only database template.
@@ -135,15 +122,14 @@ if __name__ == '__main__' :
     start = timeit.default_timer()
     
     dbfile = databaseFile;
-    homography = loadtxt(args.homography)
+    homography, invHomography = cvhomog.loadHomography(args.homography)
     
     cdb = trajstorage.CVsqlite(dbfile)
     cdb.open()
     cdb.getLatestAnnotation()
-    cdb.createBoundingBoxTable(cdb.latestannotations, inv(homography))
+    cdb.createBoundingBoxTable(cdb.latestannotations, invHomography)
     cdb.loadAnnotaion()
-    for a in cdb.annotations:
-        a.computeCentroidTrajectory(homography)
+    cdb.computeCentroidTrajectories(homography)
     print("Latest Annotaions in "+dbfile+": ", cdb.latestannotations)
     # for row in cdb.boundingbox:
     #     print(row)
@@ -151,11 +137,7 @@ if __name__ == '__main__' :
     firstFrame = cdb.frameNumbers[0]
     lastFrame = cdb.frameNumbers[-1]
     
-    foundmota = Queue()
-    IDs = Queue()
-    lock = Lock()
-    
-    Comp = GeneticCompare(foundmota, IDs, cfg_list, lock)
+    Comp = GeneticCompare(cfg_list)
     if args.accuracy != None:
         GeneticCal = cvgenetic.CVGenetic(args.population, cfg_list, Comp.computeMOT, args.accuracy)
     else:
@@ -165,9 +147,10 @@ if __name__ == '__main__' :
     else:
         GeneticCal.run_thread()
     
-    # tranform queues to lists
-    foundmota = cvgenetic.Queue_to_list(foundmota)
-    IDs = cvgenetic.Queue_to_list(IDs)
+    # the fitness (mota) of every calculated ID is kept in the genetic calculator's store
+    results = GeneticCal.store.items()
+    IDs = [i for i, mota in results]
+    foundmota = [mota for i, mota in results]
 
     Best_mota = max(foundmota)
     Best_ID = IDs[foundmota.index(Best_mota)]
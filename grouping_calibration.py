@@ -7,11 +7,8 @@ import threading
 import timeit
 from multiprocessing import Queue, Lock
 from configobj import ConfigObj
-from numpy import loadtxt
-from numpy.linalg import inv
 import matplotlib.pyplot as plt
-import moving
-from cvguipy import trajstorage, cvgenetic, cvconfig
+from cvguipy import trajstorage, cvgenetic, cvconfig, cvhomog, cvmoving
 
 """ 
 Grouping Calibration By Genetic Algorithm.
@@ -19,6 +16,16 @@ This script uses genetic algorithm to search for the best configuration.
 
 It does not monitor RAM usage, therefore, CPU thrashing might be happened when number of parents (selection size) is too large. 
 """
+# change queue into a list
+def Queue_to_list(queue):
+    # put 'None' at the end of the queue
+    queue.put(None)
+    l = []
+    # iterator stops when meet 'None'
+    for item in iter(queue.get, None):
+        l.append(item)
+    return l
+
 # class for genetic algorithm
 class GeneticCompare(object):
     def __init__(self, motalist, motplist, IDlist, cfg_list, lock):
@@ -36,22 +43,18 @@ class GeneticCompare(object):
         # create sqlite and cfg file with id i
         cfg_name = config_files +str(i)+'.cfg'
         sql_name = sqlite_files +str(i)+'.sqlite'
-        open(cfg_name,'w').close()
-        config = ConfigObj(cfg_name)
-        cfg_list.write_config(i ,config)
-        command = ['cp', 'tracking_only.sqlite', sql_name]
-        process = subprocess.Popen(command)
-        process.wait()
+        cvconfig.write_config_file(cfg_list, i, cfg_name)
+        cvconfig.copy_file_to_all('tracking_only.sqlite', sql_name)
         command = ['trajextract.py', args.inputVideo, '-o', args.homography, '-t', cfg_name, '-d', sql_name, '--gf']
         # suppress output of grouping extraction
         devnull = open(os.devnull, 'wb')
         process = subprocess.Popen(command, stdout = devnull)
         process.wait()
         
-        obj = trajstorage.CVsqlite(sql_name)
+        obj = trajstorage.CVsqlite(sql_name, tuned=True, readOnce=True)
         print "loading", i
-        obj.loadObjects()
-        motp, mota, mt, mme, fpt, gt = moving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
+        obj.loadObjects(frameRange=(firstFrame, lastFrame))
+        motp, mota, mt, mme, fpt, gt = cvmoving.computeClearMOT(cdb.annotations, obj.objects, args.matchDistance, firstFrame, lastFrame)
         if motp is None:
             motp = 0
         self.lock.acquire()
@@ -109,14 +112,15 @@ if __name__ == '__main__' :
             sys.exit(1)
         else:
             videofile=args.inputVideo
-            if 'avi' in videofile:
+            videoName, videoExt = os.path.splitext(videofile)
+            if videoExt.lower() == '.avi':
                 if args.maskFilename is not None:
                     command = ['trajextract.py',args.inputVideo,'-m', args.maskFilename,'-o', args.homography]
                 else:
                     command = ['trajextract.py',args.inputVideo,'-o', args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
-                databaseFile = videofile.replace('avi','sqlite')
+                databaseFile = videoName + '.sqlite'
                 command = ['cvplayer.py',args.inputVideo,'-d',databaseFile,'-o',args.homography]
                 process = subprocess.Popen(command)
                 process.wait()
@@ -126,6 +130,7 @@ if __name__ == '__main__' :
     else:
         databaseFile = args.databaseFile
     thread_cfgtolist.join()
+    cfg_list = cvconfig.CVConfigTable.from_list(cfg_list)
     # ------------------Done initialization for annotation-------------------- #
     
     # create first tracking only database template.
@@ -140,15 +145,14 @@ if __name__ == '__main__' :
     start = timeit.default_timer()
     
     dbfile = databaseFile;
-    homography = loadtxt(args.homography)
+    homography, invHomography = cvhomog.loadHomography(args.homography)
     
     cdb = trajstorage.CVsqlite(dbfile)
     cdb.open()
     cdb.getLatestAnnotation()
-    cdb.createBoundingBoxTable(cdb.latestannotations, inv(homography))
+    cdb.createBoundingBoxTable(cdb.latestannotations, invHomography)
     cdb.loadAnnotaion()
-    for a in cdb.annotations:
-        a.computeCentroidTrajectory(homography)
+    cdb.computeCentroidTrajectories(homography)
     print "Latest Annotaions in "+dbfile+": ", cdb.latestannotations
     
     cdb.frameNumbers = cdb.getFrameList()
@@ -171,9 +175,9 @@ if __name__ == '__main__' :
         GeneticCal.run_thread()
     
     # tranform queues to lists
-    foundmota = cvgenetic.Queue_to_list(foundmota)
-    foundmotp = cvgenetic.Queue_to_list(foundmotp)
-    IDs = cvgenetic.Queue_to_list(IDs)
+    foundmota = Queue_to_list(foundmota)
+    foundmotp = Queue_to_list(foundmotp)
+    IDs = Queue_to_list(IDs)
 
     for i in range(len(foundmotp)):
         foundmotp[i] /= args.matchDistance
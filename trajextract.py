@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
 
-import os, sys, glob
+import os, sys, glob, tempfile, atexit
 from datetime import datetime
 import argparse, argcomplete, textwrap, subprocess
-from cvguipy import cvgui
 
 appDir = os.path.dirname(__file__)
 defaultConfig = os.path.join(appDir, 'tracking.cfg')
@@ -24,7 +23,7 @@ if __name__ == '__main__':
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=textwrap.dedent("Extract trajectories from a single video file into a like-named sqlite database file using TrafficIntelligence. If there are any homography files (.txt files with 'homography' in their name, mask images (.png or .jpg files with 'mask' in their anem, or TrafficIntelligence configuration files (.cfg files with 'tracking' in their name) in the same directory as the video file, and no files are specified via arguments, the first of each qualifying file will be automatically used."))
     parser.add_argument('inputFile', help = "Video file to process. Output databases will be named by taking the input video filename and replacing the extension with 'sqlite', unless otherwise specified. Unless the '-y' flag is provided, the user must confirm before a file with the same name is overwritten (alternatively the -n flag will skip it without asking).")
-    parser.add_argument('-t', '--traffintel-config', dest='traffintelConfigFile', help = "Location of the TrafficIntelligence configuration file (tries to find one in the video directory by default, otherwise uses {})".format(defaultConfig))
+    parser.add_argument('-t', '--traffintel-config', dest='traffintelConfigFile', help = "Location of the TrafficIntelligence configuration file (tries to find one in the video directory by default, otherwise uses {}). Use '-' to read the configuration from stdin.".format(defaultConfig))
     parser.add_argument('-d', '--database-file', dest='databaseFile', help="Name of the database file to create (you must include the '.sqlite' extension). If not provided, one is generated automatically from the input video")
     parser.add_argument('-o', '--homography-file', dest='homographyFile', help = 'Location of the homography file for projecting between world space and image space (REQUIRED and UNIQUE to a specific camera placement.')
     parser.add_argument('-m', '--mask-filename', dest='maskFilename', help = "Mask image file to use when performing feature tracking (optional).")
@@ -46,7 +45,7 @@ if __name__ == '__main__':
         # make some filenames
         fdir = os.path.dirname(args.inputFile)                  # directory, so we can look for the homography
         fname, fext = os.path.splitext(args.inputFile)
-        if 'avi' in fext:
+        if fext.lower() == '.avi':
             vidfn = args.inputFile
             ovidfn = ''
             logfn = fname + '.trktime'
@@ -77,6 +76,13 @@ if __name__ == '__main__':
         maskFilename = find_file('mask', 'jpg', fdir) if maskFilename == '' else maskFilename
         print("Using mask file {}...".format(maskFilename))
         
+        # read the config from stdin if asked to (feature-based-tracking needs a file, so put it in a temporary one)
+        if args.traffintelConfigFile == '-':
+            with tempfile.NamedTemporaryFile(suffix='.cfg', delete=False) as tmpcfg:
+                tmpcfg.write(sys.stdin.buffer.read())
+            atexit.register(os.remove, tmpcfg.name)
+            args.traffintelConfigFile = tmpcfg.name
+        
         # look for a tracking config file in the file's directory
         traffintelConfigFile = find_file('tracking', 'cfg', fdir) if args.traffintelConfigFile is None else args.traffintelConfigFile # ignores case by default
         if traffintelConfigFile == '':
@@ -106,6 +112,8 @@ if __name__ == '__main__':
             elif args.groupFeaturesOnly:
                 print("Grouping features directly into input database {}...".format(fExists))
             else:
+                # cvgui pulls in OpenCV, so only import it when we have to ask (this script is run many times by the calibration scripts)
+                from cvguipy import cvgui
                 doit = cvgui.yesno("File {} exists! Overwrite? [y/N]".format(fExists))
                 if doit:
                     print("Removing old file {}...".format(fExists))